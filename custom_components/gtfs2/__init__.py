@@ -2,17 +2,20 @@
 from __future__ import annotations
 
 import logging
+import os
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant, ServiceCall
 
 from datetime import timedelta
 
-from .const import DOMAIN, PLATFORMS, DEFAULT_PATH, DEFAULT_PATH_RT, DEFAULT_REFRESH_INTERVAL
-from homeassistant.const import CONF_HOST
+from .const import DATASOURCE_SENSORS, DOMAIN, PLATFORMS, DEFAULT_PATH, DEFAULT_PATH_RT, DEFAULT_REFRESH_INTERVAL
+from homeassistant.const import CONF_HOST, EVENT_HOMEASSISTANT_STOP
 from .coordinator import GTFSUpdateCoordinator, GTFSLocalStopUpdateCoordinator
 import voluptuous as vol
 from .gtfs_helper import get_gtfs, update_gtfs_local_stops
-from .gtfs_rt_helper import get_gtfs_rt
+from .gtfs_rt_helper import get_gtfs_rt, get_realtime_hub
+from .extraction import get_extraction_queue
+from .schedules import get_schedule_registry
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -92,6 +95,9 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     hass.data[DOMAIN][entry.entry_id] = {
         "coordinator": coordinator
     }
+    get_schedule_registry(hass).add_entry(
+        os.path.join(hass.config.path(DEFAULT_PATH), entry.data["file"] + ".sqlite"), entry.entry_id
+    )
 
     entry.async_on_unload(entry.add_update_listener(update_listener))
       
@@ -104,6 +110,17 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload a config entry."""
     if unload_ok := await hass.config_entries.async_unload_platforms(entry, PLATFORMS):
         hass.data[DOMAIN].pop(entry.entry_id)
+        # the datasource sensor goes with its entry, hand it over to another loaded entry on the file
+        datasource_sensors = hass.data[DOMAIN].get(DATASOURCE_SENSORS, {})
+        if datasource_sensors.get(entry.data["file"]) == entry.entry_id:
+            datasource_sensors.pop(entry.data["file"])
+            for other in hass.config_entries.async_entries(DOMAIN):
+                if other.entry_id in hass.data[DOMAIN] and other.data.get("file") == entry.data["file"]:
+                    _LOGGER.debug("Datasource sensor of: %s, moves to entry: %s", entry.data["file"], other.title)
+                    hass.async_create_task(hass.config_entries.async_reload(other.entry_id))
+                    break
+        get_realtime_hub(hass).async_cancel_entry(entry.entry_id)
+        await hass.async_add_executor_job(get_schedule_registry(hass).remove_entry, entry.entry_id)
 
     return unload_ok
      
@@ -123,6 +140,12 @@ def setup(hass, config):
         get_gtfs_rt(hass, DEFAULT_PATH_RT, call.data)
         return True  
 
+    def cancel_gtfs_update(call):
+        """Cancel a queued or running GTFS update."""
+        _LOGGER.debug("Cancelling GTFS update with: %s", call.data)
+        get_extraction_queue(hass).cancel(hass.config.path(DEFAULT_PATH), call.data["file"])
+        return True
+
     async def update_local_stops(call):
         """My GTFS RT service."""
         _LOGGER.debug("Updating GTFS Local Stops with: %s", call.data)
@@ -135,6 +158,11 @@ def setup(hass, config):
         DOMAIN, "update_gtfs_rt_local", update_gtfs_rt_local)     
     hass.services.register(
         DOMAIN, "update_gtfs_local_stops", update_local_stops)        
+    hass.services.register(
+        DOMAIN, "cancel_gtfs_update", cancel_gtfs_update)
+
+    queue = get_extraction_queue(hass)
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, lambda event: queue.shutdown())
      
     return True
 
@@ -26,10 +26,12 @@ from .const import (
     CONF_API_KEY_NAME,
     CONF_ACCEPT_HEADER_PB,
     DEFAULT_ACCEPT_HEADER_PB,
+    DEFAULT_RT_FEED_TTL,
     DEFAULT_API_KEY_NAME,
     CONF_VEHICLE_POSITION_URL, 
     CONF_TRIP_UPDATE_URL,
     CONF_ALERTS_URL,
+    CONF_RT_FEED_TTL,
     CONF_URL,
     CONF_EXTRACT_FROM,
     CONF_FILE,
@@ -471,6 +473,7 @@ class GTFSOptionsFlowHandler(config_entries.OptionsFlow):
                         vol.Optional(CONF_API_KEY_NAME, default=self.config_entry.options.get(CONF_API_KEY_NAME,DEFAULT_API_KEY_NAME)) : str,
                         vol.Required(CONF_API_KEY_LOCATION, default=self.config_entry.options.get(CONF_API_KEY_LOCATION,DEFAULT_API_KEY_LOCATION)) : selector.SelectSelector(selector.SelectSelectorConfig(options=ATTR_API_KEY_LOCATIONS, translation_key="api_key_location")),
                         vol.Optional(CONF_ACCEPT_HEADER_PB, default = False): selector.BooleanSelector(),
+                        vol.Optional(CONF_RT_FEED_TTL, default=self.config_entry.options.get(CONF_RT_FEED_TTL, DEFAULT_RT_FEED_TTL)): vol.All(vol.Coerce(int), vol.Range(min=0)),
                     },
                 ),
                 errors=errors,
@@ -487,6 +490,7 @@ class GTFSOptionsFlowHandler(config_entries.OptionsFlow):
                         vol.Optional(CONF_API_KEY_NAME, default=self.config_entry.options.get(CONF_API_KEY_NAME,DEFAULT_API_KEY_NAME)) : str,
                         vol.Required(CONF_API_KEY_LOCATION, default=self.config_entry.options.get(CONF_API_KEY_LOCATION,DEFAULT_API_KEY_LOCATION)) : selector.SelectSelector(selector.SelectSelectorConfig(options=ATTR_API_KEY_LOCATIONS, translation_key="api_key_location")),
                         vol.Optional(CONF_ACCEPT_HEADER_PB, default = False): selector.BooleanSelector(),
+                        vol.Optional(CONF_RT_FEED_TTL, default=self.config_entry.options.get(CONF_RT_FEED_TTL, DEFAULT_RT_FEED_TTL)): vol.All(vol.Coerce(int), vol.Range(min=0)),
                     },
                 ),
                 errors=errors,
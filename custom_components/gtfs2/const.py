@@ -11,6 +11,10 @@ DEFAULT_LOCAL_STOP_TIMERANGE = 30
 DEFAULT_LOCAL_STOP_TIMERANGE_HISTORY = 15
 DEFAULT_LOCAL_STOP_RADIUS = 200
 DEFAULT_MAX_LOCAL_STOPS = 15
+# mean earth radius in meters, for the local stops distance
+EARTH_RADIUS = 6371008.8
+# seconds a fetched realtime feed is shared before it is fetched again
+DEFAULT_RT_FEED_TTL = 30
 
 DEFAULT_NAME = "GTFS Sensor2"
 DEFAULT_PATH = "gtfs2"
@@ -18,6 +22,33 @@ DEFAULT_PATH_GEOJSON = "www/gtfs2"
 DEFAULT_PATH_RT = "www/gtfs2"
 DEFAULT_API_KEY_LOCATION = "not_applicable"
 
+# bulk loader tuning
+LOADER_BATCH_SIZE = 10000
+LOADER_CACHE_SIZE_KB = 65536
+LOADER_PROGRESS_INTERVAL = 2
+DEFAULT_LOADER_WORKERS = 1
+DEFAULT_MAX_EXTRACTIONS = 1
+EXTRACTION_QUEUE = "extraction_queue"
+SCHEDULE_REGISTRY = "schedule_registry"
+DEPARTURE_BATCH = "departure_batch"
+REALTIME_HUB = "realtime_hub"
+GEOJSON_WRITER = "geojson_writer"
+DATASOURCE_SENSORS = "datasource_sensors"
+
+# feed download
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+# realtime client
+RT_FETCH_TIMEOUT = 20
+RT_FETCH_RETRIES = 2
+RT_RETRY_BACKOFF = 1
+RT_MAX_HOST_FETCHES = 4
+# seconds of feed time an entity of a differential feed is kept after it was measured, ended or last sent
+RT_ENTITY_EXPIRY = 300
+# seconds the vehicle geojson writes of the sensors on a route are merged for
+GEOJSON_WRITE_DELAY = 5
+
 CONF_DATA = "data"
 CONF_DESTINATION = "destination"
 CONF_ORIGIN = "origin"
@@ -294,6 +325,7 @@ CONF_STOP_ID = "stopid"
 CONF_TRIP_UPDATE_URL = "trip_update_url"
 CONF_VEHICLE_POSITION_URL = "vehicle_position_url"
 CONF_ALERTS_URL = "alerts_url"
+CONF_RT_FEED_TTL = "rt_feed_ttl"
 CONF_ROUTE_DELIMITER = "route_delimiter"
 CONF_ICON = "icon"
 CONF_SERVICE_TYPE = "service_type"
@@ -17,17 +17,20 @@ from .const import (
     DEFAULT_LOCAL_STOP_REFRESH_INTERVAL,
     DEFAULT_LOCAL_STOP_TIMERANGE,
     DEFAULT_LOCAL_STOP_RADIUS,
+    DEFAULT_RT_FEED_TTL,
     CONF_API_KEY,
     CONF_API_KEY_NAME,
     CONF_API_KEY_LOCATION,
     CONF_ACCEPT_HEADER_PB,
+    CONF_RT_FEED_TTL,
     ATTR_DUE_IN,
     ATTR_LATITUDE,
     ATTR_LONGITUDE,
     ATTR_RT_UPDATED_AT
 )    
+from .departures import get_datasource_pairs
 from .gtfs_helper import get_gtfs, get_next_departure, check_datasource_index, create_trip_geojson, check_extracting, get_local_stops_next_departures
-from .gtfs_rt_helper import get_next_services, get_rt_alerts
+from .gtfs_rt_helper import async_get_rt_feeds, get_next_services, get_rt_alerts, get_rt_vehicle_positions
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -50,6 +53,8 @@ class GTFSUpdateCoordinator(DataUpdateCoordinator):
         
         self._pygtfs = ""
         self._data: dict[str, str] = {}
+        # departures of the service day, see get_next_departure
+        self._timetable = None
 
     async def _async_update_data(self) -> dict[str, str]:
         """Get the latest data from GTFS and GTFS relatime, depending refresh interval"""
@@ -94,22 +99,25 @@ class GTFSUpdateCoordinator(DataUpdateCoordinator):
             _LOGGER.debug("Run static refresh: sensor without gtfs data OR refresh for name: %s", data["name"])
         
         if not run_static:
-            # do nothing awaiting refresh interval and use existing data
-            self._data = previous_data
+            # awaiting refresh interval, the next departure is looked up in the timetable of the day
+            self._data = {**previous_data, "schedule": self._pygtfs}
         else:
             check_index = await self.hass.async_add_executor_job(
                     check_datasource_index, self.hass, self._pygtfs, DEFAULT_PATH, data["file"]
                 )
 
-            try:
-                self._data["next_departure"] = await self.hass.async_add_executor_job(
-                    get_next_departure, self
-                )
+        try:
+            # config entries are read on the loop, the pairs are batched in the executor
+            self._datasource_pairs = get_datasource_pairs(self.hass, data["file"])
+            self._data["next_departure"] = await self.hass.async_add_executor_job(
+                get_next_departure, self
+            )
+            if run_static:
                 self._data["gtfs_updated_at"] = dt_util.utcnow().isoformat()
-            except Exception as ex:  # pylint: disable=broad-except
-                _LOGGER.error("Error getting gtfs data from generic helper: %s", ex)
-                return None
-            _LOGGER.debug("GTFS coordinator data from helper: %s", self._data["next_departure"]) 
+        except Exception as ex:  # pylint: disable=broad-except
+            _LOGGER.error("Error getting gtfs data from generic helper: %s", ex)
+            return None
+        _LOGGER.debug("GTFS coordinator data from helper: %s", self._data["next_departure"]) 
         
         # collect and return rt attributes
         # STILL REQUIRES A SOLUTION IF CONNECTION TIMING OUT
@@ -122,6 +130,7 @@ class GTFSUpdateCoordinator(DataUpdateCoordinator):
                 self._trip_update_url = options.get("trip_update_url", None)
                 self._vehicle_position_url = options.get("vehicle_position_url", None)
                 self._alerts_url = options.get("alerts_url", None)
+                self._rt_feed_ttl = options.get(CONF_RT_FEED_TTL, DEFAULT_RT_FEED_TTL)
                 if options.get(CONF_API_KEY_LOCATION, None) == "query_string":
                   if options.get(CONF_API_KEY, None):
                     self._trip_update_url = self._trip_update_url + "?" + options[CONF_API_KEY_NAME] + "=" + options[CONF_API_KEY]
@@ -142,8 +151,11 @@ class GTFSUpdateCoordinator(DataUpdateCoordinator):
                 self._direction = data["direction"]
                 self._relative = False
                 try:
-                    self._get_rt_alerts = await self.hass.async_add_executor_job(get_rt_alerts, self)
-                    self._get_next_service = await self.hass.async_add_executor_job(get_next_services, self)
+                    await async_get_rt_feeds(self)
+                    self._get_rt_alerts = get_rt_alerts(self)
+                    self._get_next_service = get_next_services(self)
+                    if self._rt_vehicles is not None:
+                        await self.hass.async_add_executor_job(get_rt_vehicle_positions, self, self._rt_vehicles)
                     self._data["next_departure_realtime_attr"] = self._get_next_service
                     self._data["next_departure_realtime_attr"]["gtfs_rt_updated_at"] = dt_util.utcnow()
                     self._data["alert"] = self._get_rt_alerts
@@ -193,6 +205,7 @@ class GTFSLocalStopUpdateCoordinator(DataUpdateCoordinator):
                 self._trip_update_url = options.get("trip_update_url", None)
                 self._vehicle_position_url = options.get("vehicle_position_url", None)
                 self._alerts_url = options.get("alerts_url", None)
+                self._rt_feed_ttl = options.get(CONF_RT_FEED_TTL, DEFAULT_RT_FEED_TTL)
                 if options.get(CONF_API_KEY_LOCATION, None) == "query_string":
                   if options.get(CONF_API_KEY, None):
                     self._trip_update_url = self._trip_update_url + "?" + options[CONF_API_KEY_NAME] + "=" + options[CONF_API_KEY]
@@ -223,6 +236,13 @@ class GTFSLocalStopUpdateCoordinator(DataUpdateCoordinator):
             _LOGGER.warning("Cannot update this sensor as still unpacking: %s", self._data["file"])
             previous_data["extracting"] = True
             return previous_data
+        if self._realtime:
+            try:
+                # local stops show no alerts, only trip updates and vehicles for the geojson
+                await async_get_rt_feeds(self, alerts=False)
+            except Exception as ex:  # pylint: disable=broad-except
+                _LOGGER.error("Error getting gtfs realtime data for local stops: %s", ex)
+                raise UpdateFailed(f"Error in getting realtime data: {ex}")
         try:    
             self._data["local_stops_next_departures"] = await self.hass.async_add_executor_job(
                     get_local_stops_next_departures, self
@@ -0,0 +1,253 @@
+"""Departure timetables for the GTFS integration, the sensors of a datasource are resolved in one query."""
+from __future__ import annotations
+
+import datetime
+import logging
+import threading
+
+import homeassistant.util.dt as dt_util
+from sqlalchemy.sql import text
+
+from .const import DEPARTURE_BATCH, DOMAIN
+
+_LOGGER = logging.getLogger(__name__)
+
+TIMETABLE_EPOCH = datetime.datetime(1970, 1, 1)
+TRAIN_ROUTE_TYPES = "2,100,101,102,103,104,105,106,107,108, 109,100,111,112,113,114,115,116,117"
+
+SQL_CREATE_PAIRS = """
+    CREATE TEMP TABLE IF NOT EXISTS gtfs2_pairs (
+        pair_id INTEGER, origin_stop_id TEXT, dest_stop_id TEXT, train INTEGER
+    )
+    """
+SQL_INSERT_PAIR = """
+    INSERT INTO gtfs2_pairs (pair_id, origin_stop_id, dest_stop_id, train)
+    VALUES (:pair_id, :origin_stop_id, :dest_stop_id, :train)
+    """
+SQL_TRAIN_STOPS = "SELECT stop_id FROM stops WHERE stop_name LIKE :stop_name"
+
+
+def timetable_seconds(value):
+    """Wall clock seconds, compares like the naive local time of the sensor."""
+    return int((value - TIMETABLE_EPOCH).total_seconds())
+
+
+def _pair_stops(conn, route_type, origin, destination):
+    if route_type == "2":
+        # trains are configured on the station name, any stop of that name will do
+        origins = [row[0] for row in conn.execute(text(SQL_TRAIN_STOPS), {"stop_name": str(origin) + "%"})]
+        destinations = [row[0] for row in conn.execute(text(SQL_TRAIN_STOPS), {"stop_name": str(destination) + "%"})]
+        _LOGGER.debug("Setting up TRAIN Route for start/end : %s / %s ", origins, destinations)
+    else:
+        origins = [origin.split(": ")[0]]
+        destinations = [destination.split(": ")[0]]
+        _LOGGER.debug("Setting up Route for start/end : %s / %s ", origins[0], destinations[0])
+    return [(origin_stop_id, dest_stop_id) for origin_stop_id in origins for dest_stop_id in destinations]
+
+
+def get_departure_timetables(schedule, pairs, now):
+    """Query the departures of the (route_type, origin, destination, include_tomorrow) pairs.
+
+    The pairs go in a temporary table joined against stop_times, so a single query covers
+    all of them. Returns the timetable of each pair around the service day of now.
+    """
+    now_date = now.strftime(dt_util.DATE_STR_FORMAT)
+    yesterday = now - datetime.timedelta(days=1)
+    yesterday_date = yesterday.strftime(dt_util.DATE_STR_FORMAT)
+    tomorrow = now + datetime.timedelta(days=1)
+    tomorrow_date = tomorrow.strftime(dt_util.DATE_STR_FORMAT)
+    tomorrow_select = ""
+    last_date = now_date
+    if any(pair[3] for pair in pairs):
+        _LOGGER.debug("Include Tomorrow")
+        tomorrow_select = "max(service_day.date = :tomorrow_date) AS tomorrow,"
+        last_date = tomorrow_date
+    # service_days holds the days each service runs, calendar_dates exceptions included
+    sql_query = f"""
+        SELECT pair.pair_id, trip.trip_id, trip.route_id,trip.trip_headsign,
+        route.route_long_name,route.route_short_name,
+        	   start_station.stop_id as origin_stop_id,
+               start_station.stop_name as origin_stop_name,
+               time(origin_stop_time.arrival_time) AS origin_arrival_time,
+               time(origin_stop_time.departure_time) AS origin_depart_time,
+               origin_stop_time.departure_secs / 86400 AS origin_depart_date,
+               origin_stop_time.departure_secs AS origin_depart_secs,
+               origin_stop_time.drop_off_type AS origin_drop_off_type,
+               origin_stop_time.pickup_type AS origin_pickup_type,
+               origin_stop_time.shape_dist_traveled AS origin_dist_traveled,
+               origin_stop_time.stop_headsign AS origin_stop_headsign,
+               origin_stop_time.stop_sequence AS origin_stop_sequence,
+               origin_stop_time.timepoint AS origin_stop_timepoint,
+               end_station.stop_name as dest_stop_name,
+               time(destination_stop_time.arrival_time) AS dest_arrival_time,
+               time(destination_stop_time.departure_time) AS dest_depart_time,
+               destination_stop_time.drop_off_type AS dest_drop_off_type,
+               destination_stop_time.pickup_type AS dest_pickup_type,
+               destination_stop_time.shape_dist_traveled AS dest_dist_traveled,
+               destination_stop_time.stop_headsign AS dest_stop_headsign,
+               destination_stop_time.stop_sequence AS dest_stop_sequence,
+               destination_stop_time.timepoint AS dest_stop_timepoint,
+               max(service_day.date = :yesterday_date) AS yesterday,
+               max(service_day.date = :now_date) AS today,
+               {tomorrow_select}
+               0 as today_cd
+        FROM gtfs2_pairs pair
+        INNER JOIN stop_times origin_stop_time
+                   ON origin_stop_time.stop_id = pair.origin_stop_id
+        INNER JOIN trips trip
+                   ON trip.trip_id = origin_stop_time.trip_id
+        INNER JOIN service_days service_day
+                   ON trip.service_id = service_day.service_id
+                   AND service_day.date BETWEEN :yesterday_date AND :last_date
+        INNER JOIN stops start_station
+                   ON origin_stop_time.stop_id = start_station.stop_id
+        INNER JOIN stop_times destination_stop_time
+                   ON trip.trip_id = destination_stop_time.trip_id
+                   AND destination_stop_time.stop_id = pair.dest_stop_id
+        INNER JOIN stops end_station
+                   ON destination_stop_time.stop_id = end_station.stop_id
+        INNER JOIN routes route
+                   ON route.route_id = trip.route_id
+        WHERE (pair.train = 0 OR route.route_type in ({TRAIN_ROUTE_TYPES}))
+        AND origin_stop_sequence < dest_stop_sequence
+        GROUP BY pair.pair_id, trip.trip_id, origin_stop_sequence, dest_stop_sequence
+        ORDER BY pair.pair_id, origin_depart_secs
+        """  # noqa: S608
+    with schedule.engine.connect() as conn:
+        # the temporary table lives on this pooled connection only, emptied on every use
+        conn.execute(text(SQL_CREATE_PAIRS))
+        conn.execute(text("DELETE FROM gtfs2_pairs"))
+        stop_pairs = [
+            {"pair_id": pair_id, "origin_stop_id": origin_stop_id, "dest_stop_id": dest_stop_id, "train": route_type == "2"}
+            for pair_id, (route_type, origin, destination, _) in enumerate(pairs)
+            for origin_stop_id, dest_stop_id in _pair_stops(conn, route_type, origin, destination)
+        ]
+        if stop_pairs:
+            conn.execute(text(SQL_INSERT_PAIR), stop_pairs)
+        result = conn.execute(
+            text(sql_query),
+            {
+                "yesterday_date": yesterday_date,
+                "now_date": now_date,
+                "tomorrow_date": tomorrow_date,
+                "last_date": last_date,
+            },
+        ).all()
+        conn.rollback()
+    rows_by_pair = {}
+    for row_cursor in result:
+        row = row_cursor._asdict()
+        rows_by_pair.setdefault(row.pop("pair_id"), []).append(row)
+    return [
+        _sorted_timetable(rows_by_pair.get(pair_id, []), now_date, tomorrow_date, pair[3])
+        for pair_id, pair in enumerate(pairs)
+    ]
+
+
+def _sorted_timetable(rows, now_date, tomorrow_date, include_tomorrow):
+    # Create lookup timetable for today and possibly tomorrow, taking into
+    # account any departures from yesterday scheduled after midnight,
+    # as long as all departures are within the calendar date range.
+    timetable = {}
+    yesterday_start = today_start = tomorrow_start = None
+    yesterday_last = today_last = ""
+    for row in rows:
+        if not include_tomorrow:
+            row.pop("tomorrow", None)
+        if row["yesterday"] == 1:
+            extras = {"day": "yesterday", "first": None, "last": False}
+            if yesterday_start is None:
+                yesterday_start = row["origin_depart_date"]
+            if yesterday_start != row["origin_depart_date"]:
+                idx = f"{now_date} {row['origin_depart_time']}"
+                timetable[idx] = {**row, **extras}
+                yesterday_last = idx
+        if row["today"] == 1:
+            extras = {"day": "today", "first": False, "last": False}
+            if today_start is None:
+                today_start = row["origin_depart_date"]
+                extras["first"] = True
+            if today_start == row["origin_depart_date"]:
+                idx_prefix = now_date
+            else:
+                idx_prefix = tomorrow_date
+            idx = f"{idx_prefix} {row['origin_depart_time']}"
+            timetable[idx] = {**row, **extras}
+            today_last = idx
+        if "tomorrow" in row and row["tomorrow"] == 1:
+            extras = {"day": "tomorrow", "first": False, "last": None}
+            if tomorrow_start is None:
+                tomorrow_start = row["origin_depart_date"]
+                extras["first"] = True
+            if tomorrow_start == row["origin_depart_date"]:
+                idx = f"{tomorrow_date} {row['origin_depart_time']}"
+                timetable[idx] = {**row, **extras}
+    # Flag last departures.
+    for idx in filter(None, [yesterday_last, today_last]):
+        timetable[idx]["last"] = True
+    # sorted once for the day, a lookup is a bisect on the departure seconds
+    departures = {"times": [], "items": [], "departures": [], "departures_lines": [], "departures_headsign": []}
+    for key, value in sorted(timetable.items()):
+        key_time = datetime.datetime.strptime(key, "%Y-%m-%d %H:%M:%S")
+        departure = dt_util.as_utc(key_time).isoformat()
+        departures["times"].append(timetable_seconds(key_time))
+        departures["items"].append(value)
+        departures["departures"].append(departure)
+        departures["departures_lines"].append(
+            str(departure) + " (" + str(value["route_short_name"]) +  str( ("/" + value["route_long_name"])  if value["route_long_name"] else "") + ")"
+        )
+        departures["departures_headsign"].append(str(departure) + " (" + str(value["trip_headsign"]) + ")")
+    return departures
+
+
+def get_datasource_pairs(hass, file):
+    """Return the pair of every departure sensor configured on the datasource, run on the event loop."""
+    return [
+        (entry.data["route_type"], entry.data["origin"], entry.data["destination"], entry.data["include_tomorrow"])
+        for entry in hass.config_entries.async_entries(DOMAIN)
+        if entry.data.get("file") == file and "origin" in entry.data
+    ]
+
+
+class DepartureBatch:
+    """Day timetables of the pairs on each datasource, the first sensor on a new day queries them all."""
+
+    def __init__(self):
+        self._timetables = {}
+        # one query per datasource at a time, sensors on other datasources are not held up
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_timetable(self, schedule, pair, now, pairs):
+        """Return the timetable of pair, querying it together with pairs when the day is not known yet."""
+        now_date = now.strftime(dt_util.DATE_STR_FORMAT)
+        key = (schedule, now_date)
+        database = schedule.engine.url.database
+        with self._lock:
+            database_lock = self._locks.setdefault(database, threading.Lock())
+        with database_lock:
+            with self._lock:
+                timetables = self._timetables.get(key)
+            if timetables is None or pair not in timetables:
+                batch = list(dict.fromkeys([pair, *pairs]))
+                _LOGGER.debug("Querying departures of %s pairs for: %s", len(batch), now_date)
+                timetables = dict(zip(batch, get_departure_timetables(schedule, batch, now)))
+                # keep the days still in use on this datasource, drop those of a replaced one
+                yesterday_date = (now - datetime.timedelta(days=1)).strftime(dt_util.DATE_STR_FORMAT)
+                with self._lock:
+                    self._timetables = {
+                        (cached_schedule, cached_date): cached
+                        for (cached_schedule, cached_date), cached in self._timetables.items()
+                        if cached_schedule.engine.url.database != database
+                        or (cached_schedule is schedule and cached_date >= yesterday_date)
+                    }
+                    self._timetables[key] = timetables
+            return timetables[pair]
+
+
+def get_departure_batch(hass):
+    """Return the departure batch of the integration, shared by all entries and the config flow."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    if DEPARTURE_BATCH not in domain_data:
+        domain_data[DEPARTURE_BATCH] = DepartureBatch()
+    return domain_data[DEPARTURE_BATCH]
@@ -0,0 +1,183 @@
+"""Extraction queue for the GTFS integration, builds datasources in a bounded process pool."""
+from __future__ import annotations
+
+import concurrent.futures
+import datetime
+import logging
+import multiprocessing
+import os
+import threading
+
+from .const import DEFAULT_LOADER_WORKERS, DEFAULT_MAX_EXTRACTIONS, DOMAIN, EXTRACTION_QUEUE
+from .gtfs_loader import (
+    check_changed_members,
+    check_datasource_loaded,
+    copy_datasource,
+    load_feed,
+    read_progress,
+    update_feed,
+    validate_feed,
+    write_progress,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ExtractionCancelled(Exception):
+    """Raised in the worker when the extraction was cancelled while running."""
+
+
+def _check_cancelled(cancel_file):
+    if os.path.exists(cancel_file):
+        raise ExtractionCancelled(cancel_file)
+
+
+def build_datasource(gtfs_dir, file, exclude, workers=DEFAULT_LOADER_WORKERS):
+    """Build <file>.sqlite aside from the zip and swap it in, runs in a worker process.
+
+    Returns the reloaded members, [] when nothing changed or "all" for a full load.
+    """
+    zip_file = os.path.join(gtfs_dir, file)
+    sqlite = os.path.join(gtfs_dir, file[:-4] + ".sqlite")
+    building = sqlite + ".building"
+    cancel_file = os.path.join(gtfs_dir, file[:-4] + ".cancel")
+    progress_file = os.path.join(gtfs_dir, file[:-4] + ".progress")
+    try:
+        if os.path.exists(building):
+            os.remove(building)
+        _check_cancelled(cancel_file)
+        changed = check_changed_members(sqlite, zip_file, exclude=exclude) if check_datasource_loaded(sqlite) else None
+        if changed == []:
+            return []
+        if changed:
+            # reload only the changed tables, on a copy of the datasource in use
+            copy_datasource(sqlite, building)
+            _check_cancelled(cancel_file)
+            update_feed(building, zip_file, exclude=exclude, progress_file=progress_file)
+        else:
+            load_feed(building, zip_file, workers, exclude=exclude, progress_file=progress_file)
+        _check_cancelled(cancel_file)
+        write_progress(progress_file, {**read_progress(progress_file), "state": "validating"})
+        validate_feed(building)
+        _check_cancelled(cancel_file)
+        # a loaded datasource stays in use until the new one is swapped in
+        os.replace(building, sqlite)
+        return changed or "all"
+    finally:
+        if os.path.exists(building):
+            os.remove(building)
+
+
+class ExtractionQueue:
+    """Runs datasource builds in a bounded process pool, at most one job per datasource."""
+
+    def __init__(self, max_jobs=DEFAULT_MAX_EXTRACTIONS):
+        self._max_jobs = max_jobs
+        self._executor = None
+        self._jobs = {}
+        self._status = {}
+        self._gtfs_dirs = {}
+        # reentrant, cancelling a queued future runs its done callback right away
+        self._lock = threading.RLock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn, forking the multithreaded home assistant process is not safe
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._max_jobs, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def is_active(self, name):
+        with self._lock:
+            future = self._jobs.get(name)
+            return future is not None and not future.done()
+
+    def submit(self, gtfs_dir, file, exclude, workers=DEFAULT_LOADER_WORKERS):
+        """Queue a build of the datasource for file, returns False if one is already queued or running."""
+        name = file[:-4]
+        marker = os.path.join(gtfs_dir, name + ".extracting")
+        cancel_file = os.path.join(gtfs_dir, name + ".cancel")
+        with self._lock:
+            future = self._jobs.get(name)
+            if future is not None and not future.done():
+                _LOGGER.info("Extraction already queued for: %s", name)
+                return False
+            if os.path.exists(cancel_file):
+                os.remove(cancel_file)
+            # only a first load blocks the sensors, otherwise the current datasource stays in use
+            if not check_datasource_loaded(os.path.join(gtfs_dir, name + ".sqlite")):
+                open(marker, "w").close()
+            future = self._get_executor().submit(build_datasource, gtfs_dir, file, list(exclude), workers)
+            self._jobs[name] = future
+            self._gtfs_dirs[name] = gtfs_dir
+            self._status[name] = {"state": "queued", "queued_at": datetime.datetime.now().isoformat()}
+            write_progress(os.path.join(gtfs_dir, name + ".progress"), self._status[name])
+        _LOGGER.info("Extraction queued for: %s", name)
+        future.add_done_callback(lambda f: self._job_done(gtfs_dir, name, marker, cancel_file, f))
+        return True
+
+    def _job_done(self, gtfs_dir, name, marker, cancel_file, future):
+        for path in (marker, cancel_file):
+            if os.path.exists(path):
+                os.remove(path)
+        status = {"finished_at": datetime.datetime.now().isoformat()}
+        if future.cancelled():
+            status["state"] = "cancelled"
+            _LOGGER.info("Extraction cancelled before start: %s", name)
+        elif isinstance(future.exception(), ExtractionCancelled):
+            status["state"] = "cancelled"
+            _LOGGER.info("Extraction cancelled: %s", name)
+        elif future.exception() is not None:
+            status["state"] = "failed"
+            status["error"] = str(future.exception())
+            _LOGGER.error("Error building datasource: %s, keeping current one if any, error: %s", name, future.exception())
+        else:
+            status["state"] = "done"
+            status["reloaded"] = future.result()
+            _LOGGER.info("Extraction done for: %s, reloaded: %s", name, future.result())
+        with self._lock:
+            if self._jobs.get(name) is future:
+                self._status[name].update(status)
+                # keep the counters of the last run for the datasource sensor
+                progress_file = os.path.join(gtfs_dir, name + ".progress")
+                write_progress(progress_file, {**read_progress(progress_file), **self._status[name]})
+
+    def cancel(self, gtfs_dir, name):
+        """Cancel a queued job, a running one stops at its next stage and keeps the current datasource."""
+        with self._lock:
+            future = self._jobs.get(name)
+            if future is None or future.done():
+                return False
+            if not future.cancel():
+                open(os.path.join(gtfs_dir, name + ".cancel"), "w").close()
+        _LOGGER.info("Cancelling extraction: %s", name)
+        return True
+
+    def status(self, name=None):
+        """Queue state of the jobs, queued, running or how the last run ended, with its times."""
+        with self._lock:
+            for job_name, future in self._jobs.items():
+                if future.running() and self._status[job_name]["state"] == "queued":
+                    self._status[job_name]["state"] = "running"
+            if name is not None:
+                return dict(self._status.get(name, {}))
+            return {job_name: dict(status) for job_name, status in self._status.items()}
+
+    def shutdown(self):
+        """Drop the queued jobs and stop the running ones at their next stage."""
+        with self._lock:
+            for name, future in self._jobs.items():
+                if future.running():
+                    open(os.path.join(self._gtfs_dirs[name], name + ".cancel"), "w").close()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+def get_extraction_queue(hass):
+    """Return the extraction queue of the integration, shared by all entries and the config flow."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    if EXTRACTION_QUEUE not in domain_data:
+        domain_data[EXTRACTION_QUEUE] = ExtractionQueue()
+    return domain_data[EXTRACTION_QUEUE]
@@ -1,17 +1,21 @@
 """Support for GTFS Integration."""
 from __future__ import annotations
 
+import bisect
+import csv
 import datetime
+import io
 import time
 import logging
 import os
 import glob
+import hashlib
 import json
+import math
 import requests
-import pygtfs
+import sqlite3
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql import text
-import multiprocessing
-from multiprocessing import Process
 from . import zip_file as zipfile
 from pathlib import Path
 
@@ -26,13 +30,33 @@ from .const import (
     DEFAULT_LOCAL_STOP_TIMERANGE, 
     DEFAULT_LOCAL_STOP_TIMERANGE_HISTORY,
     DEFAULT_LOCAL_STOP_RADIUS,
-    DEFAULT_PATH_RT,
+    DEFAULT_LOADER_WORKERS,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_TIMEOUT,
+    EARTH_RADIUS,
     ICON,
     ICONS,
     DOMAIN,
     TIME_STR_FORMAT
     )
-from .gtfs_rt_helper import get_rt_route_trip_statuses, get_gtfs_rt
+from .gtfs_loader import (
+    DATASOURCE_INDEXES,
+    STOPS_RTREE_TABLE,
+    add_time_columns,
+    build_service_days,
+    build_stops_rtree,
+    check_changed_members,
+    check_datasource_loaded,
+    has_service_days,
+    has_stops_rtree,
+)
+from .extraction import get_extraction_queue
+from .schedules import fetch_all, get_schedule_registry
+from .departures import get_departure_batch, timetable_seconds
+from .gtfs_rt_helper import (
+    get_rt_trip_stop_departures,
+    get_rt_vehicle_positions,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -51,243 +75,49 @@ def get_next_departure(self):
         timezone=dt_util.get_time_zone(self.hass.config.time_zone)
     schedule = self._data["schedule"]
     route_type = self._data["route_type"]
-    
-    # if type 2 (train) then filter on that and use name-like search 
-    if route_type == "2":
-        route_type_where = f"route_type in (2,100,101,102,103,104,105,106,107,108, 109,100,111,112,113,114,115,116,117)"
-        start_station_id = str(self._data['origin'])+'%'
-        end_station_id = str(self._data['destination'])+'%'
-        start_station_where = f"AND start_station.stop_id in (select stop_id from stops where stop_name like :origin_station_id)"
-        end_station_where = f"AND end_station.stop_id in (select stop_id from stops where stop_name like :end_station_id)"
-        _LOGGER.debug("Setting up TRAIN Route for start/end : %s / %s ", start_station_id, end_station_id)
-    else:
-        route_type_where = "1=1"
-        start_station_id = self._data['origin'].split(': ')[0]
-        end_station_id = self._data['destination'].split(': ')[0]
-        start_station_where = f"AND start_station.stop_id = :origin_station_id"
-        end_station_where = f"AND end_station.stop_id = :end_station_id"
-        _LOGGER.debug("Setting up Route for start/end : %s / %s ", start_station_id, end_station_id)
     offset = self._data["offset"]
     include_tomorrow = self._data["include_tomorrow"]
     now = dt_util.now().replace(tzinfo=None) + datetime.timedelta(minutes=offset)
     now_date = now.strftime(dt_util.DATE_STR_FORMAT)
     now_time = now.strftime(TIME_STR_FORMAT)
-    yesterday = now - datetime.timedelta(days=1)
-    yesterday_date = yesterday.strftime(dt_util.DATE_STR_FORMAT)
     tomorrow = now + datetime.timedelta(days=1)
     tomorrow_date = tomorrow.strftime(dt_util.DATE_STR_FORMAT)
 
-    # Fetch all departures for yesterday, today and optionally tomorrow,
-    # up to an overkill maximum in case of a departure every minute for those
-    # days.
-    limit = 24 * 60 * 60 * 2
-    tomorrow_select = tomorrow_select2 = tomorrow_where = tomorrow_order = ""
-    tomorrow_calendar_date_where = f"AND (calendar_date_today.date = date('now'))"
-    if include_tomorrow:
-        _LOGGER.debug("Include Tomorrow")
-        limit = int(limit / 2 * 3)
-        tomorrow_name = tomorrow.strftime("%A").lower()
-        tomorrow_select = f"calendar.{tomorrow_name} AS tomorrow,"
-        tomorrow_where = f"OR calendar.{tomorrow_name} = 1"
-        tomorrow_order = f"calendar.{tomorrow_name} DESC,"
-        tomorrow_calendar_date_where = f"AND (calendar_date_today.date = date('now') or calendar_date_today.date = date('now','+1 day') )"
-        tomorrow_select2 = f"CASE WHEN date('now') < calendar_date_today.date THEN '1' else '0' END as tomorrow,"
-    sql_query = f"""
-        SELECT trip.trip_id, trip.route_id,trip.trip_headsign,
-        route.route_long_name,route.route_short_name,
-        	   start_station.stop_id as origin_stop_id,
-               start_station.stop_name as origin_stop_name,
-               time(origin_stop_time.arrival_time) AS origin_arrival_time,
-               time(origin_stop_time.departure_time) AS origin_depart_time,
-               date(origin_stop_time.departure_time) AS origin_depart_date,
-               origin_stop_time.drop_off_type AS origin_drop_off_type,
-               origin_stop_time.pickup_type AS origin_pickup_type,
-               origin_stop_time.shape_dist_traveled AS origin_dist_traveled,
-               origin_stop_time.stop_headsign AS origin_stop_headsign,
-               origin_stop_time.stop_sequence AS origin_stop_sequence,
-               origin_stop_time.timepoint AS origin_stop_timepoint,
-               end_station.stop_name as dest_stop_name,
-               time(destination_stop_time.arrival_time) AS dest_arrival_time,
-               time(destination_stop_time.departure_time) AS dest_depart_time,
-               destination_stop_time.drop_off_type AS dest_drop_off_type,
-               destination_stop_time.pickup_type AS dest_pickup_type,
-               destination_stop_time.shape_dist_traveled AS dest_dist_traveled,
-               destination_stop_time.stop_headsign AS dest_stop_headsign,
-               destination_stop_time.stop_sequence AS dest_stop_sequence,
-               destination_stop_time.timepoint AS dest_stop_timepoint,
-               calendar.{yesterday.strftime("%A").lower()} AS yesterday,
-               calendar.{now.strftime("%A").lower()} AS today,
-               {tomorrow_select}
-               calendar.start_date AS start_date,
-               calendar.end_date AS end_date,
-               "" as calendar_date,
-               0 as today_cd
-        FROM trips trip
-        INNER JOIN calendar calendar
-                   ON trip.service_id = calendar.service_id
-        INNER JOIN stop_times origin_stop_time
-                   ON trip.trip_id = origin_stop_time.trip_id
-        INNER JOIN stops start_station
-                   ON origin_stop_time.stop_id = start_station.stop_id
-        INNER JOIN stop_times destination_stop_time
-                   ON trip.trip_id = destination_stop_time.trip_id
-        INNER JOIN stops end_station
-                   ON destination_stop_time.stop_id = end_station.stop_id
-        INNER JOIN routes route
-                   ON route.route_id = trip.route_id 
-		WHERE {route_type_where}
-        {start_station_where}
-        {end_station_where}
-        AND origin_stop_sequence < dest_stop_sequence
-        AND calendar.start_date <= date('now')
-        AND calendar.end_date >= date('now')
-        AND trip.service_id not in (select service_id from calendar_dates where date = date('now') and exception_type = 2)
-		UNION ALL
-	    SELECT trip.trip_id, trip.route_id,trip.trip_headsign,
-               route.route_long_name,route.route_short_name,
-               start_station.stop_id as origin_stop_id,
-               start_station.stop_name as origin_stop_name,
-               time(origin_stop_time.arrival_time) AS origin_arrival_time,
-               time(origin_stop_time.departure_time) AS origin_depart_time,
-               date(origin_stop_time.departure_time) AS origin_depart_date,
-               origin_stop_time.drop_off_type AS origin_drop_off_type,
-               origin_stop_time.pickup_type AS origin_pickup_type,
-               origin_stop_time.shape_dist_traveled AS origin_dist_traveled,
-               origin_stop_time.stop_headsign AS origin_stop_headsign,
-               origin_stop_time.stop_sequence AS origin_stop_sequence,
-               origin_stop_time.timepoint AS origin_stop_timepoint,
-               end_station.stop_name as dest_stop_name,
-               time(destination_stop_time.arrival_time) AS dest_arrival_time,
-               time(destination_stop_time.departure_time) AS dest_depart_time,
-               destination_stop_time.drop_off_type AS dest_drop_off_type,
-               destination_stop_time.pickup_type AS dest_pickup_type,
-               destination_stop_time.shape_dist_traveled AS dest_dist_traveled,
-               destination_stop_time.stop_headsign AS dest_stop_headsign,
-               destination_stop_time.stop_sequence AS dest_stop_sequence,
-               destination_stop_time.timepoint AS dest_stop_timepoint,
-               '0' AS yesterday,
-               '0' AS today,
-               {tomorrow_select2}
-               date('now') AS start_date,
-               date('now') AS end_date,
-               calendar_date_today.date as calendar_date,
-               calendar_date_today.exception_type as today_cd
-        FROM trips trip
-        INNER JOIN stop_times origin_stop_time
-                   ON trip.trip_id = origin_stop_time.trip_id
-        INNER JOIN stops start_station
-                   ON origin_stop_time.stop_id = start_station.stop_id
-        INNER JOIN stop_times destination_stop_time
-                   ON trip.trip_id = destination_stop_time.trip_id
-        INNER JOIN stops end_station
-                   ON destination_stop_time.stop_id = end_station.stop_id
-        INNER JOIN routes route
-                   ON route.route_id = trip.route_id 
-        INNER JOIN calendar_dates calendar_date_today
-				   ON trip.service_id = calendar_date_today.service_id
-		WHERE {route_type_where}
-        {start_station_where}
-        {end_station_where}
-		AND origin_stop_sequence < dest_stop_sequence
-        AND today_cd = 1
-		{tomorrow_calendar_date_where}
-        ORDER BY calendar_date,origin_depart_date, today_cd, origin_depart_time
-        """  # noqa: S608
-    result = schedule.engine.connect().execute(
-        text(sql_query),
-        {
-            "origin_station_id": start_station_id,
-            "end_station_id": end_station_id,
-            "limit": limit,
-            "route_type": route_type,
-        },
-    )
-    # Create lookup timetable for today and possibly tomorrow, taking into
-    # account any departures from yesterday scheduled after midnight,
-    # as long as all departures are within the calendar date range.
-    timetable = {}
-    yesterday_start = today_start = tomorrow_start = None
-    yesterday_last = today_last = ""
-    for row_cursor in result:
-        row = row_cursor._asdict()
-        if row["yesterday"] == 1 and yesterday_date >= row["start_date"]:
-            extras = {"day": "yesterday", "first": None, "last": False}
-            if yesterday_start is None:
-                yesterday_start = row["origin_depart_date"]
-            if yesterday_start != row["origin_depart_date"]:
-                idx = f"{now_date} {row['origin_depart_time']}"
-                timetable[idx] = {**row, **extras}
-                yesterday_last = idx
-        if row["today"] == 1 or row["today_cd"] == 1:
-            extras = {"day": "today", "first": False, "last": False}
-            if today_start is None:
-                today_start = row["origin_depart_date"]
-                extras["first"] = True
-            if today_start == row["origin_depart_date"]:
-                idx_prefix = now_date
-            else:
-                idx_prefix = tomorrow_date
-            idx = f"{idx_prefix} {row['origin_depart_time']}"
-            timetable[idx] = {**row, **extras}
-            today_last = idx
-        if (
-            "tomorrow" in row
-            and row["tomorrow"] == 1
-            and tomorrow_date <= row["end_date"]
-        ):
-            extras = {"day": "tomorrow", "first": False, "last": None}
-            if tomorrow_start is None:
-                tomorrow_start = row["origin_depart_date"]
-                extras["first"] = True
-            if tomorrow_start == row["origin_depart_date"]:
-                idx = f"{tomorrow_date} {row['origin_depart_time']}"
-                timetable[idx] = {**row, **extras}
-    # Flag last departures.
-    for idx in filter(None, [yesterday_last, today_last]):
-        timetable[idx]["last"] = True
-    item = {}
-    for key in sorted(timetable.keys()):
-        if datetime.datetime.strptime(key, "%Y-%m-%d %H:%M:%S") > now:
-            item = timetable[key]
-            _LOGGER.info(
-                "Departure found for station %s @ %s -> %s", start_station_id, key, item
-            )
-            break
-    _LOGGER.debug("item: %s", item)
-    
-    if item == {}:
-        data_returned = {        
-        "gtfs_updated_at": dt_util.utcnow().isoformat(),
-        }
-        _LOGGER.info("No items found in gtfs")
+    # the query only depends on the service day, rerun at day rollover or when the datasource changed
+    pair = (route_type, self._data["origin"], self._data["destination"], include_tomorrow)
+    timetable_key = (schedule, now_date, pair)
+    cached = getattr(self, "_timetable", None)
+    if cached is not None and cached[0] == timetable_key:
+        _LOGGER.debug("Using timetable of service day: %s", now_date)
+        timetable = cached[1]
+    else:
+        # resolved together with the other sensors on this datasource, listed by the coordinator on the loop
+        pairs = getattr(self, "_datasource_pairs", [])
+        timetable = get_departure_batch(self.hass).get_timetable(schedule, pair, now, pairs)
+        self._timetable = (timetable_key, timetable)
+
+    idx = bisect.bisect_right(timetable["times"], timetable_seconds(now))
+    if idx == len(timetable["times"]):
+        _LOGGER.debug("No items found in gtfs")
         return {}
+    item = timetable["items"][idx]
+    _LOGGER.debug(
+        "Departure found for station %s @ %s -> %s", item["origin_stop_id"], timetable["departures"][idx], item
+    )
 
     # create upcoming timetable
-    timetable_remaining = []
-    for key in sorted(timetable.keys()):
-        if datetime.datetime.strptime(key, "%Y-%m-%d %H:%M:%S") > now:
-            timetable_remaining.append(dt_util.as_utc(datetime.datetime.strptime(key, "%Y-%m-%d %H:%M:%S")).isoformat())
+    timetable_remaining = timetable["departures"][idx:]
     _LOGGER.debug(
         "Timetable Remaining Departures on this Start/Stop: %s", timetable_remaining
     )
     # create upcoming timetable with line info
-    timetable_remaining_line = []
-    for key, value in sorted(timetable.items()):
-        if datetime.datetime.strptime(key, "%Y-%m-%d %H:%M:%S") > now:
-            timetable_remaining_line.append(
-                str(dt_util.as_utc(datetime.datetime.strptime(key, "%Y-%m-%d %H:%M:%S")).isoformat()) + " (" + str(value["route_short_name"]) +  str( ("/" + value["route_long_name"])  if value["route_long_name"] else "") + ")"
-            )
+    timetable_remaining_line = timetable["departures_lines"][idx:]
     _LOGGER.debug(
         "Timetable Remaining Departures on this Start/Stop, per line: %s",
         timetable_remaining_line,
     )
     # create upcoming timetable with headsign
-    timetable_remaining_headsign = []
-    for key, value in sorted(timetable.items()):
-        if datetime.datetime.strptime(key, "%Y-%m-%d %H:%M:%S") > now:
-            timetable_remaining_headsign.append(
-                str(dt_util.as_utc(datetime.datetime.strptime(key, "%Y-%m-%d %H:%M:%S")).isoformat()) + " (" + str(value["trip_headsign"]) + ")"
-            )
+    timetable_remaining_headsign = timetable["departures_headsign"][idx:]
     _LOGGER.debug(
         "Timetable Remaining Departures on this Start/Stop, with headsign: %s",
         timetable_remaining_headsign,
@@ -296,9 +126,9 @@ def get_next_departure(self):
     # Format arrival and departure dates and times, accounting for the
     # possibility of times crossing over midnight.
     _tomorrow = False
-    if item.get("tomorrow") == 1 or item.get("calendar_date") > now_date:
+    if item.get("tomorrow") == 1:
         _tomorrow = True
-    _LOGGER.debug("Time is 'tomorrow': %s ,based on -> tomorrow_val: %s, calendar_date val: %s, now_date val: %s", _tomorrow, item.get("tomorrow"),item.get("calendar_date"), now_date)        
+    _LOGGER.debug("Time is 'tomorrow': %s ,based on -> tomorrow_val: %s, now_date val: %s", _tomorrow, item.get("tomorrow"), now_date)        
     origin_arrival = now
     dest_arrival = now
     origin_depart_time = f"{now_date} {item['origin_depart_time']}"
@@ -385,26 +215,34 @@ def get_gtfs(hass, path, data, update=False):
     file = data["file"] + ".zip"
     sqlite = data["file"] + ".sqlite"
     check_source_dates = data.get("check_source_dates", False)
+    workers = int(data.get("loader_workers", DEFAULT_LOADER_WORKERS))
     journal = os.path.join(gtfs_dir, filename + ".sqlite-journal")
+    # skip shapes (and possibly feed_info) at load, avoids a possibly very large db without rewriting the zip
+    exclude = ['shapes.txt','feed_info.txt'] if data.get("clean_feed_info", False) else ['shapes.txt']
     if check_extracting(hass, gtfs_dir,filename) and not update :
         _LOGGER.warning("Cannot use this datasource as still unpacking: %s", filename)
         return "extracting"
-    if update and data["extract_from"] == "url" and os.path.exists(os.path.join(gtfs_dir, file)):
-        remove_datasource(hass, path, filename, False)
-    if update and data["extract_from"] == "zip" and os.path.exists(os.path.join(gtfs_dir, file)) and os.path.exists(os.path.join(gtfs_dir, sqlite)):
-        os.remove(os.path.join(gtfs_dir, sqlite))      
     if data["extract_from"] == "zip":
         if not os.path.exists(os.path.join(gtfs_dir, file)):
             _LOGGER.error("The given GTFS zipfile was not found")
             return "no_zip_file"
     if data["extract_from"] == "url":
-        if not os.path.exists(os.path.join(gtfs_dir, file)):
+        if update or not os.path.exists(os.path.join(gtfs_dir, file)):
             try:
-                r = requests.get(url, allow_redirects=True)
-                open(os.path.join(gtfs_dir, file), "wb").write(r.content)
+                download_feed(url, os.path.join(gtfs_dir, file))
             except Exception as ex:  # pylint: disable=broad-except
-                _LOGGER.error("The given URL or GTFS data file/folder was not found")
+                _LOGGER.error("The given URL or GTFS data file/folder was not found, error: %s", ex)
                 return "no_data_file"                
+    # compare with what the datasource was built from, the last download may never have been built
+    if update and check_datasource_loaded(os.path.join(gtfs_dir, sqlite)):
+        try:
+            changed = check_changed_members(os.path.join(gtfs_dir, sqlite), os.path.join(gtfs_dir, file), exclude=exclude)
+        except Exception as ex:  # pylint: disable=broad-except
+            _LOGGER.debug("Cannot compare: %s, with the datasource, error: %s", file, ex)
+            changed = None
+        if changed == []:
+            _LOGGER.info("Feed not changed since the datasource was built, extracting skipped: %s", file)
+            return
     
     # if update (servicecall) then check if new file does not only have future dates
     if check_source_dates:
@@ -413,92 +251,102 @@ def get_gtfs(hass, path, data, update=False):
             return
     
     (gtfs_root, _) = os.path.splitext(file)    
-    sqlite_file = f"{gtfs_root}.sqlite?check_same_thread=False"
-    joined_path = os.path.join(gtfs_dir, sqlite_file)     
-    gtfs = pygtfs.Schedule(joined_path)
-    if not gtfs.feeds: 
-        if data.get("clean_feed_info", False):
-            extract = Process(target=extract_from_zip, args = (hass, gtfs,gtfs_dir,file,['shapes.txt','feed_info.txt']))
-        else: 
-            extract = Process(target=extract_from_zip, args = (hass, gtfs,gtfs_dir,file,['shapes.txt']))
-        extract.start()
-        extract.join()
-        _LOGGER.info("Exiting main after start subprocess for unpacking: %s", file)
+    # check before pygtfs creates an empty (indexed) schema, the loader builds its own
+    # on update only the tables of changed members are reloaded
+    if update or not check_datasource_loaded(os.path.join(gtfs_dir, f"{gtfs_root}.sqlite")):
+        extract_from_zip(hass, gtfs_dir, file, exclude, workers)
+        _LOGGER.info("Exiting main after queueing extraction: %s", file)
         return "extracting"
-    return gtfs
+    # shared by all entries on this datasource, reopened once a new file is swapped in
+    return get_schedule_registry(hass).get(os.path.join(gtfs_dir, f"{gtfs_root}.sqlite"))
 
-def extract_from_zip(hass, gtfs, gtfs_dir, file, remove_file):
-    _LOGGER.debug("Extracting gtfs file: %s", file)
-    # first remove shapes from zip to avoid possibly very large db 
-    clean = remove_from_zip(remove_file,gtfs_dir, file[:-4])    
-    if os.fork() != 0:
-        return
-    pygtfs.append_feed(gtfs, os.path.join(gtfs_dir, file))
-    check_datasource_index(hass, gtfs, gtfs_dir, file[:-4])
+def download_feed(url, zip_file):
+    """Download a feed to zip_file, streamed and conditional on the previous download.
+
+    ETag, Last-Modified and sha256 of the stored archive are kept in <zip_file>.meta,
+    the archive is only rewritten when it changed. Whether the datasource needs a
+    rebuild is left to the member check against the datasource, see get_gtfs.
+    """
+    meta_file = zip_file + ".meta"
+    meta = {}
+    if os.path.exists(zip_file) and os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    download = zip_file + ".download"
+    sha256 = hashlib.sha256()
+    with requests.get(url, headers=headers, stream=True, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 304:
+            _LOGGER.debug("Feed not modified: %s", url)
+            return
+        r.raise_for_status()
+        with open(download, "wb") as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                sha256.update(chunk)
+                f.write(chunk)
+        new_meta = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "sha256": sha256.hexdigest(),
+        }
+    if new_meta["sha256"] != meta.get("sha256"):
+        os.replace(download, zip_file)
+    else:
+        _LOGGER.debug("Feed downloaded but identical: %s", url)
+        os.remove(download)
+    with open(meta_file, "w") as f:
+        json.dump(new_meta, f)
+
+def extract_from_zip(hass, gtfs_dir, file, remove_file, workers=DEFAULT_LOADER_WORKERS):
+    _LOGGER.debug("Queueing extraction of gtfs file: %s", file)
+    return get_extraction_queue(hass).submit(gtfs_dir, file, remove_file, workers)
     
 def check_calendar_dates_from_zip(gtfs_dir,file):
     _LOGGER.debug("Checking if file contains only future data: %s ", file)
     filename = os.path.join(gtfs_dir, file)
-    # Rename existing sqlite if existing (i.e. in case of a fresh install)
-    if os.path.exists(os.path.join(gtfs_dir, file[:-4] + ".sqlite")):
-        os.rename (os.path.join(gtfs_dir, file[:-4] + '.sqlite'), os.path.join(gtfs_dir, file[:-4] + '.sqlite_current'))
-    #Load the ZIP archive
-    zin = zipfile.ZipFile (f"{os.path.join(gtfs_dir, filename)}", 'r')
-    check_list=[]
+    # the current sqlite is left as is, an update only reloads changed tables
     try:
-        for item in zin.infolist():
-            if item.filename[0:8] == 'calendar' :
-                if item.filename == 'calendar.txt':
-                    column = 'start_date'
-                else:
-                    column = 'date'
-                with open(zin.extract(item.filename)) as f:
-                    header = f.readline().strip('\n')   #
-                    data = f.readlines() 
-                    index =header.replace('"','').split(',').index(column)           
-                    list = []
-                    for line in data:
-                        list.append(line.split(',')[index])
-                    check_list.append(min(list))
-        min_date = datetime.datetime.strptime(min(check_list),"%Y%m%d")
-        _LOGGER.debug("Youngest calender date from new files: %s, is: %s", check_list, min_date)
-        if min_date > datetime.datetime.now()  :
+        windows = get_calendar_windows_from_zip(filename)
+        min_date = min(start for (start, end) in windows.values())
+        _LOGGER.debug("Youngest calender date from new files: %s, is: %s", windows, min_date)
+        if min_date > datetime.date.today()  :
             _LOGGER.info("New file contains only dates in the future, keeping current")
-            if os.path.exists(os.path.join(gtfs_dir, file[:-4] + ".sqlite")):
-                os.remove(os.path.join(gtfs_dir, file[:-4] + ".sqlite"))
-            os.rename (os.path.join(gtfs_dir, file[:-4] + '.sqlite_current'), os.path.join(gtfs_dir, file[:-4] + '.sqlite'))
             return False
     except Exception as ex:
-        _LOGGER.error("Error getting earliest dates from zip, continuing with extract, error: %s", ex)
-        _LOGGER.debug(f"Removing/restoring sqlite after error")
-        if os.path.exists(os.path.join(gtfs_dir, file[:-4] + ".sqlite")):
-            os.remove(os.path.join(gtfs_dir, file[:-4] + ".sqlite"))
-        if os.path.exists(os.path.join(gtfs_dir, file[:-4] + ".sqlite")):
-            os.rename (os.path.join(gtfs_dir, file[:-4] + '.sqlite'), os.path.join(gtfs_dir, file[:-4] + '.sqlite_current'))
+        _LOGGER.error("Error getting earliest dates from zip, error: %s", ex)
         return False
-    _LOGGER.debug(f"New file is not containing only newer dates, removing current/copied sqlite")    
-    if os.path.exists(os.path.join(gtfs_dir, file[:-4] + ".sqlite_current")):
-        os.remove(os.path.join(gtfs_dir, file[:-4] + ".sqlite_current"))
+    _LOGGER.debug(f"New file is not containing only newer dates")    
     return True
 
-def remove_from_zip(delmelist,gtfs_dir,file):
-    _LOGGER.debug("Removing data: %s , from zipfile: %s", delmelist, file)
-    tempfile = file + "_temp.zip"
-    tempfile_out = file + "_temp_out.zip"
-    filename = file + ".zip"
-    os.rename (os.path.join(gtfs_dir, filename), os.path.join(gtfs_dir, tempfile))
-    # Load the ZIP archive
-    zin = zipfile.ZipFile (f"{os.path.join(gtfs_dir, tempfile)}", 'r')
-    zout = zipfile.ZipFile (f"{os.path.join(gtfs_dir, tempfile_out)}", 'w')
-    for item in zin.infolist():
-        buffer = zin.read(item.filename)
-        if (item.filename not in delmelist):
-            zout.writestr(item, buffer)
-    zout.close()
-    zin.close()
-    os.rename(os.path.join(gtfs_dir, tempfile_out), os.path.join(gtfs_dir, filename))
-    os.remove(os.path.join(gtfs_dir, tempfile)) 
-   
+def get_calendar_windows_from_zip(zip_file):
+    """Return the (first, last) service date per calendar member, read in one streaming pass."""
+    windows = {}
+    with zipfile.ZipFile(zip_file, 'r') as zin:
+        members = set(zin.namelist())
+        for (member, start_column, end_column) in (("calendar.txt", "start_date", "end_date"), ("calendar_dates.txt", "date", "date")):
+            if member not in members:
+                continue
+            first = last = None
+            with io.TextIOWrapper(zin.open(member, 'r'), encoding="utf-8-sig", newline="") as f:
+                for row in csv.DictReader(f, skipinitialspace=True):
+                    # removed dates do not add to the validity of the feed
+                    if member == "calendar_dates.txt" and (row.get("exception_type") or "").strip() == "2":
+                        continue
+                    start = (row.get(start_column) or "").strip()
+                    end = (row.get(end_column) or "").strip()
+                    if start and (first is None or start < first):
+                        first = start
+                    if end and (last is None or end > last):
+                        last = end
+            if first and last:
+                windows[member] = (datetime.datetime.strptime(first, "%Y%m%d").date(), datetime.datetime.strptime(last, "%Y%m%d").date())
+    _LOGGER.debug("Calendar windows for: %s, are: %s", zip_file, windows)
+    return windows
+
 
 def get_route_list(schedule, data):
     _LOGGER.debug("Getting routes with data: %s", data)
@@ -517,10 +365,7 @@ def get_route_list(schedule, data):
     {agency_where}
     order by agency_name, cast(route_id as decimal)
     """  # noqa: S608
-    result = schedule.engine.connect().execute(
-        text(sql_routes),
-        {"q": "q"},
-    )
+    result = fetch_all(schedule, sql_routes)
     routes_list = []
     routes = []
     for row_cursor in result:
@@ -543,10 +388,7 @@ def get_stop_list(schedule, route_id, direction):
     and (t.direction_id = {direction} or t.direction_id is null)
     order by st.stop_sequence
     """  # noqa: S608
-    result = schedule.engine.connect().execute(
-        text(sql_stops),
-        {"q": "q"},
-    )
+    result = fetch_all(schedule, sql_stops)
     stops_list = []
     stops = []
     for row_cursor in result:
@@ -565,10 +407,7 @@ def get_agency_list(schedule, data):
     from agency a
     order by a.agency_name
     """
-    result = schedule.engine.connect().execute(
-        text(sql_agencies),
-        {"q": "q"},
-    )
+    result = fetch_all(schedule, sql_agencies)
     agencies_list = []
     agencies = []
     for row_cursor in result:
@@ -592,9 +431,10 @@ def get_datasources(hass, path) -> dict[str]:
     _LOGGER.debug(f"Datasources in folder: {datasources}")
     return datasources
 
-def remove_datasource(hass, path, filename, include_sqlite):
+def remove_datasource(hass, path, filename, include_sqlite=True):
     gtfs_dir = hass.config.path(path)
     _LOGGER.info(f"Removing datasource: {os.path.join(gtfs_dir, filename)}.*")
+    get_schedule_registry(hass).invalidate(os.path.join(gtfs_dir, filename + ".sqlite"))
     if include_sqlite and os.path.exists(os.path.join(gtfs_dir, filename + ".sqlite")):
         os.remove(os.path.join(gtfs_dir, filename + ".sqlite"))
     if os.path.exists(os.path.join(gtfs_dir, filename + "_temp.zip")):     
@@ -603,6 +443,16 @@ def remove_datasource(hass, path, filename, include_sqlite):
         os.remove(os.path.join(gtfs_dir, filename + "_temp_out.zip"))
     if os.path.exists(os.path.join(gtfs_dir, filename + ".sqlite-journal")):        
         os.remove(os.path.join(gtfs_dir, filename + ".sqlite-journal"))
+    if os.path.exists(os.path.join(gtfs_dir, filename + ".extracting")):        
+        os.remove(os.path.join(gtfs_dir, filename + ".extracting"))
+    if os.path.exists(os.path.join(gtfs_dir, filename + ".sqlite.building")):        
+        os.remove(os.path.join(gtfs_dir, filename + ".sqlite.building"))
+    if os.path.exists(os.path.join(gtfs_dir, filename + ".progress")):        
+        os.remove(os.path.join(gtfs_dir, filename + ".progress"))
+    if os.path.exists(os.path.join(gtfs_dir, filename + ".zip.download")):        
+        os.remove(os.path.join(gtfs_dir, filename + ".zip.download"))
+    if os.path.exists(os.path.join(gtfs_dir, filename + ".zip.meta")):        
+        os.remove(os.path.join(gtfs_dir, filename + ".zip.meta"))
     if os.path.exists(os.path.join(gtfs_dir, filename + ".zip")):        
         os.remove(os.path.join(gtfs_dir, filename + ".zip"))        
     return "removed"
@@ -613,7 +463,12 @@ def check_extracting(hass, gtfs_dir,file):
     filename = file
     journal = os.path.join(gtfs_dir, filename + ".sqlite-journal")
     tempzip = os.path.join(gtfs_dir, filename + "_temp.zip")
-    if os.path.exists(journal)  or os.path.exists(tempzip):
+    marker = os.path.join(gtfs_dir, filename + ".extracting")
+    # a marker without a queued job is left over from a restart during extraction
+    if os.path.exists(marker) and not get_extraction_queue(hass).is_active(filename):
+        _LOGGER.warning("Removing stale extraction marker: %s", marker)
+        os.remove(marker)
+    if os.path.exists(journal)  or os.path.exists(tempzip) or os.path.exists(marker):
         _LOGGER.debug("Extracting: yes")
         return True
     return False    
@@ -669,68 +524,38 @@ def check_datasource_index(hass, schedule, gtfs_dir, file):
     sql_add_index_5 = f"""
     create index gtfs2_routes_route_type on routes(route_type)
     """      
-    result_1a = schedule.engine.connect().execute(
-        text(sql_index_1),
-        {"q": "q"},
-    )
-    for row_cursor in result_1a:
-        _LOGGER.debug("IDX result1: %s", row_cursor._asdict())
-        if row_cursor._asdict()['checkidx'] == 0:
-            _LOGGER.warning("Adding index 1 to improve performance")
-            result_1b = schedule.engine.connect().execute(
-            text(sql_add_index_1),
-            {"q": "q"},
-            )        
-        
-    result_2a = schedule.engine.connect().execute(
-        text(sql_index_2),
-        {"q": "q"},
-    )
-    for row_cursor in result_2a:
-        _LOGGER.debug("IDX result2: %s", row_cursor._asdict())
-        if row_cursor._asdict()['checkidx'] == 0:
-            _LOGGER.warning("Adding index 2 to improve performance")
-            result_2b = schedule.engine.connect().execute(
-            text(sql_add_index_2),
-            {"q": "q"},
-            )
-            
-    result_3a = schedule.engine.connect().execute(
-        text(sql_index_3),
-        {"q": "q"},
-    )
-    for row_cursor in result_3a:
-        _LOGGER.debug("IDX result3: %s", row_cursor._asdict())
-        if row_cursor._asdict()['checkidx'] == 0:
-            _LOGGER.warning("Adding index 3 to improve performance")
-            result_3b = schedule.engine.connect().execute(
-            text(sql_add_index_3),
-            {"q": "q"},
-            )    
-    result_4a = schedule.engine.connect().execute(
-        text(sql_index_4),
-        {"q": "q"},
-    )
-    for row_cursor in result_4a:
-        _LOGGER.debug("IDX result4: %s", row_cursor._asdict())
-        if row_cursor._asdict()['checkidx'] == 0:
-            _LOGGER.warning("Adding index 4 to improve performance")
-            result_4b = schedule.engine.connect().execute(
-            text(sql_add_index_4),
-            {"q": "q"},
-            )  
-    result_5a = schedule.engine.connect().execute(
-        text(sql_index_5),
-        {"q": "q"},  
-    )
-    for row_cursor in result_5a:
-        _LOGGER.debug("IDX result5: %s", row_cursor._asdict())
-        if row_cursor._asdict()['checkidx'] == 0:
-            _LOGGER.warning("Adding index 5 to improve performance")
-            result_5b = schedule.engine.connect().execute(
-            text(sql_add_index_5),
-            {"q": "q"},
-            )                 
+    # one connection for all checks, the added indexes are committed with it
+    with schedule.engine.connect() as conn:
+        checks = [
+            (sql_index_1, sql_add_index_1),
+            (sql_index_2, sql_add_index_2),
+            (sql_index_3, sql_add_index_3),
+            (sql_index_4, sql_add_index_4),
+            (sql_index_5, sql_add_index_5),
+        ]
+        for idx, (sql_index, sql_add_index) in enumerate(checks, start=1):
+            checkidx = conn.execute(text(sql_index)).scalar()
+            _LOGGER.debug("IDX result%s: %s", idx, checkidx)
+            if checkidx == 0:
+                _LOGGER.warning("Adding index %s to improve performance", idx)
+                conn.execute(text(sql_add_index))
+        conn.commit()
+    # integer time columns used by the departure queries, datasources from before get them once
+    conn = sqlite3.connect(schedule.engine.url.database)
+    try:
+        added = add_time_columns(conn)
+        if added:
+            _LOGGER.warning("Adding columns %s to improve performance", added)
+        if not has_service_days(conn):
+            _LOGGER.warning("Adding service days to improve performance")
+            build_service_days(conn)
+        if not has_stops_rtree(conn) and build_stops_rtree(conn):
+            _LOGGER.warning("Adding stops rtree to improve performance")
+        for sql in DATASOURCE_INDEXES:
+            conn.execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
             
 def create_trip_geojson(self):
     # not in use, awaiting geojson in HA-core to cover this type of geometry
@@ -745,10 +570,7 @@ def create_trip_geojson(self):
     and t.trip_id = '{self._trip_id}'
     order by s.shape_pt_sequence
     """
-    result = schedule.engine.connect().execute(
-        text(sql_shape),
-        {"q": "q"},
-    )
+    result = fetch_all(schedule, sql_shape)
     shapes_list = []
     coordinates = []
     for row_cursor in result:
@@ -768,26 +590,60 @@ def get_local_stop_list(hass, schedule, data):
     device_tracker = hass.states.get(data['device_tracker_id'])
     latitude = device_tracker.attributes.get("latitude", None)
     longitude = device_tracker.attributes.get("longitude", None) 
-    radius = data.get("radius", DEFAULT_LOCAL_STOP_RADIUS) / 111111
-    sql_query = f"""
-        SELECT stop.stop_id, stop.stop_name
-        FROM stops stop
-        where abs(stop.stop_lat - :latitude) < :radius and abs(stop.stop_lon - :longitude) < :radius
-        """  
-    result = schedule.engine.connect().execute(
-        text(sql_query),
-        {
-            "latitude": latitude,
-            "longitude": longitude,
-            "radius": radius
-        },
-    )   
-    rowcount = 0
-    for row_cursor in result:
-        rowcount += 1
+    rowcount = len(get_nearby_stops(schedule, latitude, longitude, data.get("radius", DEFAULT_LOCAL_STOP_RADIUS)))
     _LOGGER.debug("Local stops list output: %s", rowcount)
     return rowcount
-        
+
+
+def _distance(lat1, lon1, lat2, lon2):
+    # haversine, in meters
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def get_nearby_stops(schedule, latitude, longitude, radius):
+    """Return the ids of the stops within radius meters of latitude/longitude.
+
+    A bounding box on the stops R*Tree narrows down the candidates, their distance decides.
+    """
+    if latitude is None or longitude is None:
+        return []
+    lat_delta = math.degrees(radius / EARTH_RADIUS)
+    # the box widens in longitude away from the equator
+    lon_delta = lat_delta / max(math.cos(math.radians(latitude)), 0.01)
+    box = {
+        "min_lat": latitude - lat_delta,
+        "max_lat": latitude + lat_delta,
+        "min_lon": longitude - lon_delta,
+        "max_lon": longitude + lon_delta,
+    }
+    sql_rtree = f"""
+        SELECT stop.stop_id, stop.stop_lat, stop.stop_lon
+        FROM {STOPS_RTREE_TABLE} box
+        INNER JOIN stops stop ON stop.rowid = box.id
+        WHERE box.max_lat >= :min_lat AND box.min_lat <= :max_lat
+        AND box.max_lon >= :min_lon AND box.min_lon <= :max_lon
+        """  # noqa: S608
+    sql_box = """
+        SELECT stop.stop_id, stop.stop_lat, stop.stop_lon
+        FROM stops stop
+        WHERE stop.stop_lat BETWEEN :min_lat AND :max_lat
+        AND stop.stop_lon BETWEEN :min_lon AND :max_lon
+        """
+    try:
+        candidates = fetch_all(schedule, sql_rtree, box)
+    except OperationalError as ex:
+        # datasource from before the rtree, or sqlite without the rtree module
+        _LOGGER.debug("Stops rtree not available, using a bounding box on stops: %s", ex)
+        candidates = fetch_all(schedule, sql_box, box)
+    stop_ids = [
+        row.stop_id for row in candidates
+        if _distance(latitude, longitude, row.stop_lat, row.stop_lon) <= radius
+    ]
+    _LOGGER.debug("Stops within %s meters: %s of %s candidates", radius, len(stop_ids), len(candidates))
+    return stop_ids
+
 
 def get_local_stops_next_departures(self):
     if self.hass.config.time_zone is None:
@@ -813,82 +669,54 @@ def get_local_stops_next_departures(self):
     latitude = device_tracker.attributes.get("latitude", None)
     longitude = device_tracker.attributes.get("longitude", None)
     include_tomorrow = self._data["include_tomorrow"]    
-    tomorrow_select = tomorrow_select2 = tomorrow_where = tomorrow_order = ""
-    tomorrow_calendar_date_where = f"AND (calendar_date_today.date = date(:now_offset))"
-    time_range = str('+' + str(self._data.get("timerange", DEFAULT_LOCAL_STOP_TIMERANGE)) + ' minute')
-    time_range_history = str('-' + str(self._data.get("timerange_history", DEFAULT_LOCAL_STOP_TIMERANGE_HISTORY)) + ' minute')
-    radius = self._data.get("radius", DEFAULT_LOCAL_STOP_RADIUS) / 111111
+    tomorrow_select = ""
+    last_date = now_date
+    # departure time of day within the window, as before also for trips of the previous day past 24:00:00
+    now_secs = now.hour * 3600 + now.minute * 60 + now.second
+    window_start = max(now_secs - int(self._data.get("timerange_history", DEFAULT_LOCAL_STOP_TIMERANGE_HISTORY)) * 60, 0)
+    window_end = min(now_secs + int(self._data.get("timerange", DEFAULT_LOCAL_STOP_TIMERANGE)) * 60, 86399)
     if not latitude or not longitude:
         _LOGGER.error("No latitude and/or longitude for : %s", self._data['device_tracker_id'])
         return []
+    stop_ids = get_nearby_stops(schedule, latitude, longitude, self._data.get("radius", DEFAULT_LOCAL_STOP_RADIUS))
     if include_tomorrow:
         _LOGGER.debug("Includes Tomorrow")
-        tomorrow_name = tomorrow.strftime("%A").lower()
-        tomorrow_select = f"calendar.{tomorrow_name} AS tomorrow,"
-        tomorrow_calendar_date_where = f"AND (calendar_date_today.date = date(:now_offset) or calendar_date_today.date = date(:now_offset,'+1 day'))"
-        tomorrow_select2 = f"CASE WHEN date(:now_offset) < calendar_date_today.date THEN '1' else '0' END as tomorrow,"        
+        tomorrow_select = "max(service_day.date = :tomorrow_date) AS tomorrow,"
+        last_date = tomorrow_date
+    # service_days holds the days each service runs, calendar_dates exceptions included,
+    # the nearby stops come first so stop_times is searched on (stop_id, departure_secs)
     sql_query = f"""
-        SELECT * FROM (
         SELECT stop.stop_id, stop.stop_name,stop.stop_lat as latitude, stop.stop_lon as longitude, trip.trip_id, trip.trip_headsign, trip.direction_id, time(st.departure_time) as departure_time,
                route.route_long_name,route.route_short_name,route.route_type,
-               calendar.{now.strftime("%A").lower()} AS today,
+               max(service_day.date = :now_date) AS today,
                {tomorrow_select}
-               calendar.start_date AS start_date,
-               calendar.end_date AS end_date,
-               date(:now_offset) as calendar_date,
-               0 as today_cd, 
                route.route_id
-        FROM trips trip
-        INNER JOIN calendar calendar
-                   ON trip.service_id = calendar.service_id
-        INNER JOIN stop_times st
+        FROM json_each(:stop_ids) nearby
+        CROSS JOIN stop_times st
+                   ON st.stop_id = nearby.value
+        INNER JOIN trips trip
                    ON trip.trip_id = st.trip_id
+        INNER JOIN service_days service_day
+                   ON trip.service_id = service_day.service_id
+                   AND service_day.date BETWEEN :now_date AND :last_date
         INNER JOIN stops stop
-                   on stop.stop_id = st.stop_id and abs(stop.stop_lat - :latitude) < :radius and abs(stop.stop_lon - :longitude) < :radius
+                   on stop.stop_id = st.stop_id
         INNER JOIN routes route
                    ON route.route_id = trip.route_id 
-		WHERE 
-        trip.service_id not in (select service_id from calendar_dates where date = date(:now_offset) and exception_type = 2)
-        and  datetime(date(:now_offset) || ' ' || time(st.departure_time) ) between  datetime(:now_offset,:timerange_history) and  datetime(:now_offset,:timerange) 
-        AND calendar.start_date <= date(:now_offset) 
-        AND calendar.end_date >= date(:now_offset) 
-        )
-		UNION ALL
-        SELECT * FROM (
-	    SELECT stop.stop_id, stop.stop_name,stop.stop_lat as latitude, stop.stop_lon as longitude, trip.trip_id, trip.trip_headsign, trip.direction_id, time(st.departure_time) as departure_time,
-               route.route_long_name,route.route_short_name,route.route_type,
-               '0' AS today,
-               {tomorrow_select2}
-               date(:now_offset) AS start_date,
-               date(:now_offset) AS end_date,
-               calendar_date_today.date as calendar_date,
-               calendar_date_today.exception_type as today_cd,
-               route.route_id
-        FROM trips trip
-        INNER JOIN stop_times st
-                   ON trip.trip_id = st.trip_id
-        INNER JOIN stops stop
-                   on stop.stop_id = st.stop_id and abs(stop.stop_lat - :latitude) < :radius and abs(stop.stop_lon - :longitude) < :radius
-        INNER JOIN routes route
-                   ON route.route_id = trip.route_id 
-        INNER JOIN calendar_dates calendar_date_today
-				   ON trip.service_id = calendar_date_today.service_id
-		WHERE 
-        today_cd = 1
-        and  datetime(date(:now_offset) || ' ' || time(st.departure_time) ) between  datetime(:now_offset,:timerange_history) and  datetime(:now_offset,:timerange) 
-		{tomorrow_calendar_date_where}
-        )
-        order by stop_id, tomorrow, departure_time
+		WHERE (st.departure_secs between :window_start and :window_end or st.departure_secs between :window_start + 86400 and :window_end + 86400)
+        GROUP BY st.trip_id, st.stop_sequence
+        order by stop.stop_id, tomorrow, departure_time
         """  # noqa: S608
-    result = schedule.engine.connect().execute(
-        text(sql_query),
+    result = fetch_all(
+        schedule,
+        sql_query,
         {
-            "latitude": latitude,
-            "longitude": longitude,
-            "timerange": time_range,
-            "timerange_history": time_range_history,
-            "radius": radius,
-            "now_offset": now
+            "stop_ids": json.dumps(stop_ids),
+            "window_start": window_start,
+            "window_end": window_end,
+            "now_date": now_date,
+            "tomorrow_date": tomorrow_date,
+            "last_date": last_date,
         },
     )        
     timetable = []
@@ -897,22 +725,11 @@ def get_local_stops_next_departures(self):
     prev_entry = entry = {}
     
     
-    # Set elements for realtime retrieval via local file.
+    # the realtime feeds were fetched by the coordinator
     if self._realtime:
         self._rt_group = "trip"
-        self._rt_data = {
-            "url": self._trip_update_url,
-            "headers": self._headers,
-            "file": self._data["name"] + "_localstop",
-            }
-        check = get_gtfs_rt(self.hass,DEFAULT_PATH_RT,self._rt_data)
-        # check if local file created
-        if check != "ok":
-            _LOGGER.error("Could not download RT data from: %s", self._trip_update_url)
-            return False
-        else:
-            # use local file created as new url
-            self._trip_update_url = "file://" + DEFAULT_PATH_RT + "/" + self._data["name"] + "_localstop.rt"
+        vehicle_entities = self._rt_vehicles
+        vehicle_routes = set()
 
     for row_cursor in result:
         row = row_cursor._asdict()
@@ -922,7 +739,7 @@ def get_local_stops_next_departures(self):
             timetable = []
         entry = {"stop_id": row['stop_id'], "stop_name": row['stop_name'], "latitude": row['latitude'], "longitude": row['longitude'], "departure": timetable, "offset": offset}
         self._icon = ICONS.get(row['route_type'], ICON)
-        if row["today"] == 1 or (row["today_cd"] == 1 and row["start_date"] == row["calendar_date"]):
+        if row["today"] == 1:
             self._trip_id = row["trip_id"]
             self._direction = str(row["direction_id"])
             self._route = row['route_id']   
@@ -934,13 +751,14 @@ def get_local_stops_next_departures(self):
             if self._realtime:
                 self._get_next_service = {}
                 _LOGGER.debug("Find rt for local stop route: %s - direction: %s - stop: %s", self._route , self._direction, self._stop_id)
-                next_service = get_rt_route_trip_statuses(self)
-                
-                if next_service:                       
-                    delays = next_service.get(self._route, {}).get(self._direction, {}).get(self._stop_id, []).get("delays", [])
-                    departures = next_service.get(self._route, {}).get(self._direction, {}).get(self._stop_id, []).get("departures", [])
-                    delay_rt = delays[0] if delays else "-"
-                    departure_rt = departures[0] if departures else "-"
+                if vehicle_entities is not None and (self._route, self._direction) not in vehicle_routes:
+                    vehicle_routes.add((self._route, self._direction))
+                    get_rt_vehicle_positions(self, vehicle_entities)
+                next_service = get_rt_trip_stop_departures(self._rt_index, self._route, self._trip_id, self._stop_id)
+                delays = next_service.get("delays", [])
+                departures = next_service.get("departures", [])
+                delay_rt = delays[0] if delays else "-"
+                departure_rt = departures[0] if departures else "-"
                     
             if departure_rt != '-':
                 depart_time_corrected = departures[0]
@@ -0,0 +1,657 @@
+"""Bulk loader for GTFS static feeds."""
+from __future__ import annotations
+
+import concurrent.futures
+import csv
+import datetime
+import functools
+import io
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from pygtfs.feed import derive_feed_name
+from pygtfs.gtfs_entities import (
+    Base,
+    ShapePoint,
+    Stop,
+    Translation,
+    Trip,
+    gtfs_all,
+    gtfs_calendar,
+    gtfs_required,
+)
+from sqlalchemy.dialects import sqlite as sqlite_dialect
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.types import Boolean, Date, Float, Integer, Interval, Numeric
+
+from . import zip_file as zipfile
+from .const import LOADER_BATCH_SIZE, LOADER_CACHE_SIZE_KB, LOADER_PROGRESS_INTERVAL
+
+_LOGGER = logging.getLogger(__name__)
+
+_DIALECT = sqlite_dialect.dialect()
+
+# archive members the datasource was loaded from, for differential updates
+MEMBERS_TABLE = "gtfs2_members"
+# indexes used by the departure queries, check_datasource_index adds them to older datasources
+DATASOURCE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS gtfs2_stop_times_trip_id ON stop_times(trip_id)",
+    "CREATE INDEX IF NOT EXISTS gtfs2_stop_times_stop_id ON stop_times(stop_id)",
+    "CREATE INDEX IF NOT EXISTS gtfs2_shapes_shape_id ON shapes(shape_id)",
+    "CREATE INDEX IF NOT EXISTS gtfs2_stops_stop_name ON stops(stop_name)",
+    "CREATE INDEX IF NOT EXISTS gtfs2_routes_route_type ON routes(route_type)",
+    "CREATE INDEX IF NOT EXISTS gtfs2_stop_times_stop_id_departure_secs ON stop_times(stop_id, departure_secs)",
+]
+# integer seconds since midnight of the service day, next to the pygtfs interval columns, for range queries
+TIME_COLUMNS = {
+    "stop_times": [("arrival_secs", "arrival_time"), ("departure_secs", "departure_time")],
+}
+# one row per day a service runs, calendar and calendar_dates expanded over the feed validity
+SERVICE_DAYS_TABLE = "service_days"
+# R*Tree over the stop coordinates, for the local stops radius search
+STOPS_RTREE_TABLE = "gtfs2_stops_rtree"
+# tables feeding _stop_translations and _trip_shapes
+RELATION_SOURCES = {Stop, Translation, Trip, ShapePoint}
+
+# Pragmas used while the datasource is being built, the file is not in use
+# by anyone else and a crash means a rebuild anyway
+LOADER_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA locking_mode = EXCLUSIVE",
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA cache_size = -{LOADER_CACHE_SIZE_KB}",
+]
+
+
+def _to_bool(value):
+    return 1 if value == "1" else 0
+
+
+@functools.lru_cache(maxsize=None)
+def _to_date(value):
+    # stored like sqlalchemy stores a Date on sqlite
+    return f"{value[0:4]}-{value[4:6]}-{value[6:8]}"
+
+
+def gtfs_time_to_seconds(value):
+    """Convert a GTFS time (may exceed 24:00:00) to seconds since midnight."""
+    (hours, minutes, seconds) = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+@functools.lru_cache(maxsize=None)
+def _to_interval(value):
+    # stored like sqlalchemy stores an Interval on sqlite: epoch + timedelta
+    (days, seconds) = divmod(gtfs_time_to_seconds(value), 86400)
+    (hours, seconds) = divmod(seconds, 3600)
+    (minutes, seconds) = divmod(seconds, 60)
+    return f"1970-01-{days + 1:02d} {hours:02d}:{minutes:02d}:{seconds:02d}.000000"
+
+
+@functools.lru_cache(maxsize=None)
+def _interval_to_seconds(value):
+    # back from the stored interval, days past the epoch are hours past 24:00:00
+    if value is None:
+        return None
+    return (int(value[8:10]) - 1) * 86400 + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+
+
+def _column_converter(column):
+    if isinstance(column.type, Boolean):
+        return _to_bool
+    if isinstance(column.type, Integer):
+        return int
+    if isinstance(column.type, (Float, Numeric)):
+        return float
+    if isinstance(column.type, Date):
+        return _to_date
+    if isinstance(column.type, Interval):
+        return _to_interval
+    return None
+
+
+def create_schema(conn, with_indexes=True):
+    """Create the pygtfs tables (and indexes) if not yet there."""
+    for table in Base.metadata.sorted_tables:
+        conn.execute(str(CreateTable(table, if_not_exists=True).compile(dialect=_DIALECT)))
+    add_time_columns(conn)
+    if with_indexes:
+        create_indexes(conn)
+
+
+def add_time_columns(conn):
+    """Add the integer time columns where missing, filled from the interval columns, returns the added ones."""
+    added = []
+    for (table_name, columns) in TIME_COLUMNS.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+        if not existing:
+            continue
+        for (name, source) in columns:
+            if name in existing:
+                continue
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {name} INTEGER")
+            conn.execute(
+                f"UPDATE {table_name} SET {name} = CAST(round((julianday({source}) - julianday('1970-01-01')) * 86400) AS INTEGER)"
+            )
+            added.append(name)
+    return added
+
+
+def _column_names(table_name):
+    return [c.name for c in Base.metadata.tables[table_name].columns] + [name for (name, _) in TIME_COLUMNS.get(table_name, [])]
+
+
+def create_indexes(conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            conn.execute(str(CreateIndex(index, if_not_exists=True).compile(dialect=_DIALECT)))
+    for sql in DATASOURCE_INDEXES:
+        conn.execute(sql)
+
+
+def read_rows(raw, columns):
+    """Yield a tuple per row for the given columns of a csv member opened from the archive."""
+    with io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader, [])]
+        picks = []
+        for column in columns:
+            # pygtfs defaults, e.g. agency_id 'None' when an agency is not given
+            default = column.default.arg if column.default is not None and not callable(column.default.arg) else None
+            index = header.index(column.name) if column.name in header else None
+            picks.append((index, _column_converter(column), default))
+        width = len(header)
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                row += [""] * (width - len(row))
+            values = []
+            for (index, convert, default) in picks:
+                value = row[index].strip() if index is not None else ""
+                if value == "":
+                    values.append(default)
+                elif convert is None:
+                    values.append(value)
+                else:
+                    values.append(convert(value))
+            yield tuple(values)
+
+
+def load_table(conn, zin, gtfs_class, feed_id, progress=None):
+    """Load one gtfs table from the archive with batched inserts, returns the row count."""
+    table = gtfs_class.__table__
+    columns = [c for c in table.columns if c.name != "feed_id"]
+    names = ["feed_id"] + [c.name for c in columns]
+    sources = [names.index(source) for (_, source) in TIME_COLUMNS.get(table.name, [])]
+    names += [name for (name, _) in TIME_COLUMNS.get(table.name, [])]
+    sql = f"INSERT OR IGNORE INTO {table.name} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})"
+    member = table.name + ".txt"
+    rows = 0
+    batch = []
+    raw = zin.open(member, "r")
+    for values in read_rows(raw, columns):
+        values = (feed_id,) + values
+        if sources:
+            values += tuple(_interval_to_seconds(values[i]) for i in sources)
+        batch.append(values)
+        if len(batch) >= LOADER_BATCH_SIZE:
+            conn.executemany(sql, batch)
+            rows += len(batch)
+            batch = []
+            if progress is not None:
+                # uncompressed position in the member, a little ahead of the rows because of buffering
+                progress.update(table.name, rows, raw.tell())
+    if batch:
+        conn.executemany(sql, batch)
+        rows += len(batch)
+    if progress is not None:
+        progress.update(table.name, rows, done=True)
+    _LOGGER.debug("Loaded %s rows for table: %s", rows, table.name)
+    return rows
+
+
+class LoadProgress:
+    """Per table progress of a load, published in a small json file for the datasource sensor."""
+
+    def __init__(self, progress_file, zin, gtfs_classes):
+        self.progress_file = progress_file
+        self.state = "loading"
+        self.table = None
+        self.tables = {
+            c.__tablename__: {"rows": 0, "bytes_read": 0, "bytes_total": zin.getinfo(c.__tablename__ + ".txt").file_size}
+            for c in gtfs_classes
+        }
+        self.started = time.monotonic()
+        self.started_at = datetime.datetime.now().isoformat()
+        self.written = 0
+        self.write()
+
+    def update(self, table, rows, bytes_read=None, done=False):
+        self.table = table
+        self.tables[table]["rows"] = rows
+        self.tables[table]["bytes_read"] = self.tables[table]["bytes_total"] if done else bytes_read
+        if done or time.monotonic() - self.written >= LOADER_PROGRESS_INTERVAL:
+            self.write()
+
+    def set_state(self, state):
+        self.state = state
+        self.write()
+
+    def write(self):
+        self.written = time.monotonic()
+        elapsed = max(self.written - self.started, 0.001)
+        rows = sum(t["rows"] for t in self.tables.values())
+        bytes_read = sum(t["bytes_read"] for t in self.tables.values())
+        bytes_total = sum(t["bytes_total"] for t in self.tables.values())
+        # the archive is read at a roughly constant rate, rows per byte varies a lot between tables
+        eta = (bytes_total - bytes_read) * elapsed / bytes_read if bytes_read else None
+        write_progress(self.progress_file, {
+            "state": self.state,
+            "table": self.table,
+            "rows": rows,
+            "rows_per_sec": round(rows / elapsed),
+            "bytes_read": bytes_read,
+            "bytes_total": bytes_total,
+            "eta_seconds": round(eta) if eta is not None and self.state == "loading" else None,
+            "started_at": self.started_at,
+            "updated_at": datetime.datetime.now().isoformat(),
+            "tables": self.tables,
+        })
+
+
+def read_progress(progress_file):
+    """Return the last published progress of a datasource, {} if there is none."""
+    try:
+        with open(progress_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_progress(progress_file, status):
+    # replace in one go, the sensor may read at any time
+    with open(progress_file + ".tmp", "w") as f:
+        json.dump(status, f)
+    os.replace(progress_file + ".tmp", progress_file)
+
+
+def add_missing_services(conn, feed_id):
+    """Add a dummy calendar entry for services only in calendar_dates, as pygtfs does."""
+    conn.execute(
+        """
+        INSERT INTO calendar (feed_id, service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday, start_date, end_date)
+        SELECT cd.feed_id, cd.service_id, 0, 0, 0, 0, 0, 0, 0, cd.date, cd.date
+        FROM calendar_dates cd
+        WHERE cd.feed_id = :feed_id
+        AND cd.rowid IN (select min(rowid) from calendar_dates where feed_id = :feed_id group by service_id)
+        AND cd.service_id NOT IN (select service_id from calendar where feed_id = :feed_id)
+        """,
+        {"feed_id": feed_id},
+    )
+
+
+def build_service_days(conn):
+    """Fill service_days from calendar (weekdays within start/end) and calendar_dates (added/removed days)."""
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {SERVICE_DAYS_TABLE} "
+        "(service_id VARCHAR NOT NULL, date DATE NOT NULL, PRIMARY KEY (service_id, date)) WITHOUT ROWID"
+    )
+    conn.execute(f"CREATE INDEX IF NOT EXISTS gtfs2_service_days_date ON {SERVICE_DAYS_TABLE}(date)")
+    conn.execute(f"DELETE FROM {SERVICE_DAYS_TABLE}")
+    # expanded in sqlite, a large feed has millions of service days
+    conn.execute(
+        f"""
+        INSERT OR IGNORE INTO {SERVICE_DAYS_TABLE} (service_id, date)
+        WITH RECURSIVE days (service_id, date, end_date, sunday, monday, tuesday, wednesday, thursday, friday, saturday) AS (
+            SELECT service_id, start_date, end_date, sunday, monday, tuesday, wednesday, thursday, friday, saturday
+            FROM calendar
+            WHERE start_date <= end_date
+            AND monday + tuesday + wednesday + thursday + friday + saturday + sunday > 0
+            UNION ALL
+            SELECT service_id, date(date, '+1 day'), end_date, sunday, monday, tuesday, wednesday, thursday, friday, saturday
+            FROM days
+            WHERE date < end_date
+        )
+        SELECT service_id, date FROM days
+        WHERE CASE strftime('%w', date)
+            WHEN '0' THEN sunday WHEN '1' THEN monday WHEN '2' THEN tuesday WHEN '3' THEN wednesday
+            WHEN '4' THEN thursday WHEN '5' THEN friday ELSE saturday END
+        ORDER BY service_id, date
+        """
+    )
+    # calendar_dates: 1 adds the day, 2 removes it
+    conn.execute(
+        f"INSERT OR IGNORE INTO {SERVICE_DAYS_TABLE} (service_id, date) "
+        "SELECT service_id, date FROM calendar_dates WHERE exception_type = 1"
+    )
+    conn.execute(
+        f"DELETE FROM {SERVICE_DAYS_TABLE} WHERE (service_id, date) IN "
+        "(SELECT service_id, date FROM calendar_dates WHERE exception_type = 2)"
+    )
+    _LOGGER.debug("Service days: %s", conn.execute(f"SELECT count(*) FROM {SERVICE_DAYS_TABLE}").fetchone()[0])
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def has_service_days(conn):
+    return _has_table(conn, SERVICE_DAYS_TABLE)
+
+
+def build_stops_rtree(conn):
+    """Fill the stops R*Tree keyed on the stops rowid, returns False when sqlite has no rtree module."""
+    try:
+        conn.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {STOPS_RTREE_TABLE} USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+        )
+    except sqlite3.OperationalError as ex:
+        _LOGGER.debug("No stops rtree, local stops use a plain bounding box: %s", ex)
+        return False
+    conn.execute(f"DELETE FROM {STOPS_RTREE_TABLE}")
+    conn.execute(
+        f"INSERT INTO {STOPS_RTREE_TABLE} (id, min_lat, max_lat, min_lon, max_lon) "
+        "SELECT rowid, stop_lat, stop_lat, stop_lon, stop_lon FROM stops WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL"
+    )
+    return True
+
+
+def has_stops_rtree(conn):
+    return _has_table(conn, STOPS_RTREE_TABLE)
+
+
+def add_relations(conn, feed_id, loaded):
+    """Fill the many-to-many tables pygtfs uses for translations and shapes."""
+    if Translation in loaded:
+        conn.execute(
+            """
+            INSERT INTO _stop_translations (stop_feed_id, translation_feed_id, stop_id, trans_id, lang)
+            SELECT s.feed_id, t.feed_id, s.stop_id, t.trans_id, t.lang
+            FROM stops s, translations t
+            WHERE s.feed_id = :feed_id and t.feed_id = :feed_id and s.stop_name = t.trans_id
+            """,
+            {"feed_id": feed_id},
+        )
+    if ShapePoint in loaded:
+        conn.execute(
+            """
+            INSERT INTO _trip_shapes (trip_feed_id, shape_feed_id, trip_id, shape_id, shape_pt_sequence)
+            SELECT t.feed_id, s.feed_id, t.trip_id, s.shape_id, s.shape_pt_sequence
+            FROM trips t, shapes s
+            WHERE t.feed_id = :feed_id and s.feed_id = :feed_id and s.shape_id = t.shape_id
+            """,
+            {"feed_id": feed_id},
+        )
+
+
+def _load_staging(staging_file, zip_file, table_name, feed_id):
+    """Worker: load a single table into its own staging sqlite file."""
+    gtfs_class = next(c for c in gtfs_all if c.__tablename__ == table_name)
+    if os.path.exists(staging_file):
+        os.remove(staging_file)
+    conn = sqlite3.connect(staging_file, isolation_level=None)
+    zin = zipfile.ZipFile(zip_file, "r")
+    try:
+        for pragma in LOADER_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute(str(CreateTable(gtfs_class.__table__).compile(dialect=_DIALECT)))
+        add_time_columns(conn)
+        conn.execute("BEGIN")
+        rows = load_table(conn, zin, gtfs_class, feed_id)
+        conn.execute("COMMIT")
+        return rows
+    finally:
+        conn.close()
+        zin.close()
+
+
+def merge_staging(conn, staging_file, table_name):
+    """Copy a staging table into the datasource with ATTACH and INSERT ... SELECT."""
+    columns = ", ".join(_column_names(table_name))
+    conn.execute("ATTACH DATABASE ? AS staging", (staging_file,))
+    try:
+        conn.execute("BEGIN")
+        conn.execute(f"INSERT OR IGNORE INTO main.{table_name} ({columns}) SELECT {columns} FROM staging.{table_name}")
+        conn.execute("COMMIT")
+    finally:
+        conn.execute("DETACH DATABASE staging")
+    os.remove(staging_file)
+    _LOGGER.debug("Merged staging table: %s", table_name)
+
+
+def _load_tables_parallel(conn, sqlite_file, zip_file, gtfs_classes, feed_id, workers, progress=None):
+    """Load the tables in a process pool, each into a staging file, and merge them as they finish."""
+    staging = {c.__tablename__: f"{sqlite_file}.{c.__tablename__}.staging" for c in gtfs_classes}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(_load_staging, staging_file, zip_file, table_name, feed_id): table_name
+            for (table_name, staging_file) in staging.items()
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                table_name = futures[future]
+                _LOGGER.debug("Loaded %s rows for table: %s", future.result(), table_name)
+                merge_staging(conn, staging[table_name], table_name)
+                if progress is not None:
+                    # the workers do not report, progress per finished table only
+                    progress.update(table_name, future.result(), done=True)
+        finally:
+            for future in futures:
+                future.cancel()
+            for staging_file in staging.values():
+                if os.path.exists(staging_file):
+                    os.remove(staging_file)
+
+
+def _check_members(members):
+    gtfs_classes = [c for c in gtfs_all if c.__tablename__ + ".txt" in members]
+    for gtfs_class in gtfs_required:
+        if gtfs_class not in gtfs_classes:
+            raise IOError("Error: could not find %s" % (gtfs_class.__tablename__ + ".txt"))
+    if not set(gtfs_classes) & gtfs_calendar:
+        raise IOError("Must have calendar.txt or calendar_dates.txt")
+    return gtfs_classes
+
+
+def get_members(conn):
+    """Return the archive members (crc, size) the datasource was loaded from, None if unknown."""
+    try:
+        return {row[0]: (row[1], row[2]) for row in conn.execute(f"SELECT member, crc, file_size FROM {MEMBERS_TABLE}")}
+    except sqlite3.OperationalError:
+        return None
+
+
+def store_members(conn, infos):
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {MEMBERS_TABLE} (member TEXT PRIMARY KEY, crc INTEGER, file_size INTEGER)")
+    conn.execute(f"DELETE FROM {MEMBERS_TABLE}")
+    conn.executemany(
+        f"INSERT INTO {MEMBERS_TABLE} (member, crc, file_size) VALUES (?, ?, ?)",
+        [(member, crc, size) for (member, (crc, size)) in infos.items()],
+    )
+
+
+def _member_infos(zin, gtfs_classes):
+    # crc and size from the central directory, enough to detect a changed member
+    return {
+        c.__tablename__ + ".txt": (zin.getinfo(c.__tablename__ + ".txt").CRC, zin.getinfo(c.__tablename__ + ".txt").file_size)
+        for c in gtfs_classes
+    }
+
+
+def load_feed(sqlite_file, zip_file, workers=1, exclude=(), progress_file=None):
+    """Load a GTFS zip into a sqlite file readable by pygtfs.Schedule.
+
+    Members listed in exclude (e.g. shapes.txt) are skipped, the archive
+    itself is not modified. With more than one worker the tables are loaded
+    at the same time in a process pool, this needs extra disk space for the
+    staging files. With a progress_file the progress is published there.
+    """
+    _LOGGER.info("Bulk loading: %s, into: %s, with workers: %s, excluding: %s", zip_file, sqlite_file, workers, exclude)
+    start = datetime.datetime.now()
+    zin = zipfile.ZipFile(zip_file, "r")
+    gtfs_classes = _check_members(set(zin.namelist()) - set(exclude))
+    progress = LoadProgress(progress_file, zin, gtfs_classes) if progress_file else None
+    conn = sqlite3.connect(sqlite_file, isolation_level=None)
+    try:
+        for pragma in LOADER_PRAGMAS:
+            conn.execute(pragma)
+        create_schema(conn, with_indexes=False)
+        cursor = conn.execute(
+            "INSERT INTO _feed (feed_name, feed_append_date) VALUES (?, ?)",
+            (derive_feed_name(zip_file), datetime.date.today().isoformat()),
+        )
+        feed_id = cursor.lastrowid
+        if workers > 1 and len(gtfs_classes) > 1:
+            _load_tables_parallel(conn, sqlite_file, zip_file, gtfs_classes, feed_id, workers, progress)
+        else:
+            for gtfs_class in gtfs_classes:
+                conn.execute("BEGIN")
+                load_table(conn, zin, gtfs_class, feed_id, progress)
+                conn.execute("COMMIT")
+        if progress is not None:
+            progress.set_state("indexing")
+        conn.execute("BEGIN")
+        add_missing_services(conn, feed_id)
+        build_service_days(conn)
+        build_stops_rtree(conn)
+        add_relations(conn, feed_id, gtfs_classes)
+        create_indexes(conn)
+        store_members(conn, _member_infos(zin, gtfs_classes))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+        zin.close()
+    _LOGGER.info("Bulk loading done for: %s, in: %s", zip_file, datetime.datetime.now() - start)
+    return feed_id
+
+
+def get_changed_members(conn, zin, exclude=()):
+    """Return the tables whose archive member changed since the last load, None if unknown."""
+    stored = get_members(conn)
+    if stored is None:
+        return None
+    gtfs_classes = _check_members(set(zin.namelist()) - set(exclude))
+    infos = _member_infos(zin, gtfs_classes)
+    changed = {c for c in gtfs_all if infos.get(c.__tablename__ + ".txt") != stored.get(c.__tablename__ + ".txt")}
+    # dummy services from calendar_dates live in calendar, reload both together
+    if changed & gtfs_calendar:
+        changed |= gtfs_calendar
+    return changed
+
+
+def check_changed_members(sqlite_file, zip_file, exclude=()):
+    """Return the members that changed in the archive, [] if none, None if a full load is needed."""
+    zin = zipfile.ZipFile(zip_file, "r")
+    conn = sqlite3.connect(f"file:{sqlite_file}?mode=ro", uri=True)
+    try:
+        changed = get_changed_members(conn, zin, exclude)
+    finally:
+        conn.close()
+        zin.close()
+    if changed is None:
+        return None
+    return sorted(c.__tablename__ + ".txt" for c in changed)
+
+
+def update_feed(sqlite_file, zip_file, exclude=(), progress_file=None):
+    """Reload only the tables whose archive member changed since the last load.
+
+    Meant for a private copy of the datasource, see copy_datasource. Returns
+    the reloaded members, or None when the datasource does not know what it
+    was loaded from and needs a full load.
+    """
+    start = datetime.datetime.now()
+    zin = zipfile.ZipFile(zip_file, "r")
+    conn = sqlite3.connect(sqlite_file, isolation_level=None)
+    try:
+        changed = get_changed_members(conn, zin, exclude)
+        if changed is None:
+            _LOGGER.info("No member information in: %s, needs a full load", sqlite_file)
+            return None
+        if not changed:
+            _LOGGER.info("No changed members in: %s, nothing to reload", zip_file)
+            return []
+        _LOGGER.info("Reloading changed members: %s, from: %s", sorted(c.__tablename__ for c in changed), zip_file)
+        gtfs_classes = _check_members(set(zin.namelist()) - set(exclude))
+        progress = LoadProgress(progress_file, zin, [c for c in gtfs_classes if c in changed]) if progress_file else None
+        feed_id = conn.execute("SELECT max(feed_id) FROM _feed").fetchone()[0]
+        for pragma in LOADER_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute("BEGIN")
+        # datasources from before the integer time columns get them here
+        add_time_columns(conn)
+        for gtfs_class in [c for c in gtfs_all if c in changed]:
+            # one feed per datasource, no need to filter on feed_id
+            conn.execute(f"DELETE FROM {gtfs_class.__tablename__}")
+            if gtfs_class in gtfs_classes:
+                load_table(conn, zin, gtfs_class, feed_id, progress)
+        if progress is not None:
+            progress.set_state("indexing")
+        if changed & gtfs_calendar:
+            add_missing_services(conn, feed_id)
+        if changed & gtfs_calendar or not has_service_days(conn):
+            build_service_days(conn)
+        # the rtree refers to stops by rowid, a reload renumbers them
+        if Stop in changed or not has_stops_rtree(conn):
+            build_stops_rtree(conn)
+        if changed & RELATION_SOURCES:
+            conn.execute("DELETE FROM _stop_translations")
+            conn.execute("DELETE FROM _trip_shapes")
+            add_relations(conn, feed_id, gtfs_classes)
+        create_indexes(conn)
+        store_members(conn, _member_infos(zin, gtfs_classes))
+        conn.execute("UPDATE _feed SET feed_append_date = ? WHERE feed_id = ?", (datetime.date.today().isoformat(), feed_id))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+        zin.close()
+    _LOGGER.info("Reloading done for: %s, in: %s", zip_file, datetime.datetime.now() - start)
+    return sorted(c.__tablename__ + ".txt" for c in changed)
+
+
+def copy_datasource(sqlite_file, target_file):
+    """Copy a datasource in use to a private file with the sqlite backup api."""
+    if os.path.exists(target_file):
+        os.remove(target_file)
+    source = sqlite3.connect(f"file:{sqlite_file}?mode=ro", uri=True)
+    target = sqlite3.connect(target_file)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def validate_feed(sqlite_file):
+    """Sanity check a built datasource before it is put in use, raises if not usable."""
+    conn = sqlite3.connect(f"file:{sqlite_file}?mode=ro", uri=True)
+    try:
+        (result,) = conn.execute("PRAGMA quick_check").fetchone()
+        if result != "ok":
+            raise sqlite3.DatabaseError(f"Integrity check failed: {result}")
+        if conn.execute("SELECT count(*) FROM _feed").fetchone()[0] != 1:
+            raise IOError("Expected exactly one feed")
+        for gtfs_class in gtfs_required:
+            if conn.execute(f"SELECT 1 FROM {gtfs_class.__tablename__} LIMIT 1").fetchone() is None:
+                raise IOError(f"No data in table: {gtfs_class.__tablename__}")
+    finally:
+        conn.close()
+
+
+def check_datasource_loaded(sqlite):
+    """Check if a sqlite datasource exists and holds a feed, without creating the schema."""
+    if not os.path.exists(sqlite):
+        return False
+    try:
+        conn = sqlite3.connect(f"file:{sqlite}?mode=ro", uri=True)
+        try:
+            return conn.execute("SELECT count(*) FROM _feed").fetchone()[0] > 0
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
@@ -1,16 +1,30 @@
+import asyncio
+import bisect
 import logging
 from datetime import datetime, timedelta
+from functools import partial
+import hashlib
 import json
 import os
+import random
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
 
+import aiohttp
 import homeassistant.helpers.config_validation as cv
 import homeassistant.util.dt as dt_util
 import requests
 import voluptuous as vol
+from google.protobuf.message import DecodeError
 from google.transit import gtfs_realtime_pb2
 from homeassistant.components.sensor import PLATFORM_SCHEMA
 from homeassistant.const import ATTR_LATITUDE, ATTR_LONGITUDE, CONF_NAME
+from homeassistant.core import callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.event import async_call_later
 from homeassistant.util import Throttle
 
 from .requests_testadapter import Resp
@@ -46,11 +60,21 @@ from .const import (
     CONF_ICON,
     CONF_SERVICE_TYPE,
 
+    DEFAULT_RT_FEED_TTL,
     DEFAULT_SERVICE,
     DEFAULT_ICON,
     DEFAULT_DIRECTION,
     DEFAULT_PATH,
     DEFAULT_PATH_GEOJSON,
+    DOMAIN,
+    GEOJSON_WRITE_DELAY,
+    GEOJSON_WRITER,
+    REALTIME_HUB,
+    RT_ENTITY_EXPIRY,
+    RT_FETCH_RETRIES,
+    RT_FETCH_TIMEOUT,
+    RT_MAX_HOST_FETCHES,
+    RT_RETRY_BACKOFF,
 
     TIME_STR_FORMAT
 )
@@ -60,38 +84,310 @@ def due_in_minutes(timestamp):
     diff = timestamp - dt_util.now().replace(tzinfo=None)
     return int(diff.total_seconds() / 60)
 
-def get_gtfs_feed_entities(url: str, headers, label: str):
-    _LOGGER.debug(f"GTFS RT get_feed_entities for url: {url} , headers: {headers}, label: {label}")
+class RealtimeFetchError(Exception):
+    """Raised when a realtime feed could not be fetched."""
+
+
+def _feed_is_json(content, content_type):
+    # tell a JSON feed from a protobuf one without decoding the payload
+    if "json" in content_type:
+        return True
+    return content.lstrip()[:1] == b"{"
+
+def parse_feed(content, content_type, label, as_json=False):
+    """Header and entities of a fetched feed, protobuf messages for a protobuf feed unless as_json is set."""
     feed = gtfs_realtime_pb2.FeedMessage()  # type: ignore
 
+    if label == "alerts":
+        _LOGGER.debug("Feed : %s", feed)
+
+    if _feed_is_json(content, content_type):
+        try:
+            json_object = json.loads(content)
+            return json_object.get('header', {}), json_object.get('entity')
+        except ValueError:
+            _LOGGER.debug("Not a JSON feed, reading %s as protobuf", label)
+    # nested dicts are only built for the debug output, the sensors read the messages
+    if as_json and label == "vehicle_positions":
+        json_object = convert_gtfs_realtime_positions_to_json(content)
+        return json_object.get('header', {}), json_object.get('entity')
+    if as_json and label == "trip_data":
+        json_object = convert_gtfs_realtime_to_json(content)
+        return json_object.get('header', {}), json_object.get('entity')
+    feed.ParseFromString(content)
+    return feed.header, feed.entity
+
+def _is_differential(header):
+    if isinstance(header, dict):
+        return header.get("incrementality") in ("DIFFERENTIAL", gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL)
+    return header.incrementality == gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+
+def get_gtfs_feed_entities(url: str, headers, label: str, as_json=False):
+    _LOGGER.debug(f"GTFS RT get_feed_entities for url: {url} , headers: {headers}, label: {label}")
+
     if url.startswith('file'):
         requests_session = requests.session()
         requests_session.mount('file://', LocalFileAdapter())
         response = requests_session.get(url)   
     else:
-        response = requests.get(url, headers=headers, timeout=20)
+        response = requests.get(url, headers=headers, timeout=RT_FETCH_TIMEOUT)
 
     if response.status_code == 200:
         _LOGGER.debug("Successfully updated %s", label)
     else:
         _LOGGER.debug("Updating %s, and got: %s for: %s", label, response.status_code, response.content)
 
-    if label == "alerts":
-        _LOGGER.debug("Feed : %s", feed)
-        
+    return parse_feed(response.content, response.headers.get("Content-Type", ""), label, as_json)[1]
+
+def _read_local_feed(url):
+    with open(url[7:], "rb") as file:
+        return file.read()
+
+async def async_fetch_feed(hass, url, headers, limit):
+    """Payload and response headers of a realtime feed, on the shared aiohttp session.
+
+    The payload is None for a 304. Timeouts, connection errors, 429 and 5xx responses
+    are retried with a jittered backoff.
+    """
+    if url.startswith('file'):
+        return await hass.async_add_executor_job(_read_local_feed, url), {}
+    session = async_get_clientsession(hass)
+    timeout = aiohttp.ClientTimeout(total=RT_FETCH_TIMEOUT)
+    for attempt in range(RT_FETCH_RETRIES + 1):
+        if attempt:
+            # full jitter, the entries polling the same host do not retry in step
+            await asyncio.sleep(random.uniform(0, RT_RETRY_BACKOFF * 2 ** (attempt - 1)))
+        try:
+            async with limit, session.get(url, headers=headers, timeout=timeout) as response:
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            error = RealtimeFetchError(f"{url}: {ex!r}")
+            _LOGGER.debug("Fetching realtime feed failed, attempt: %s, error: %s", attempt + 1, error)
+            continue
+        if response.status == 200:
+            _LOGGER.debug("Successfully fetched realtime feed: %s", url)
+            return content, response.headers
+        if response.status == 304:
+            _LOGGER.debug("Realtime feed not modified: %s", url)
+            return None, response.headers
+        error = RealtimeFetchError(f"{url}: status {response.status}")
+        _LOGGER.debug("Fetching realtime feed failed, attempt: %s, error: %s", attempt + 1, error)
+        if response.status < 500 and response.status != 429:
+            break
+    raise error
+
+def _read_varint(content, pos):
+    value = shift = 0
+    while pos < len(content):
+        byte = content[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+    raise ValueError("truncated varint")
+
+def feed_header_timestamp(content):
+    """FeedHeader.timestamp of a protobuf feed, read without parsing the entities, None if unknown."""
+    # the header is field 1 of the FeedMessage, serialized ahead of the entities
+    if content[:1] != b"\x0a":
+        return None
+    header = gtfs_realtime_pb2.FeedHeader()  # type: ignore
     try:
-        json_object = json.loads(response.content)
-        feed = json_object       
-    except ValueError as e:   
-        if label == "vehicle_positions":
-            feed = convert_gtfs_realtime_positions_to_json(response.content)
-        elif label == "trip_data":
-            feed = convert_gtfs_realtime_to_json(response.content)
-        else: # not yet converted to json
-            feed.ParseFromString(response.content)
-            return feed.entity            
-    
-    return feed.get('entity')
+        length, pos = _read_varint(content, 1)
+        header.ParseFromString(content[pos:pos + length])
+    except (ValueError, DecodeError):
+        return None
+    return header.timestamp or None
+
+def _timestamp(message):
+    # uint64 timestamp of a protobuf message or of its JSON dict (a string), 0 when missing
+    return int(_field(message, "timestamp", 0) or 0)
+
+def _entity_timestamp(entity, feed_time):
+    # when the entity was measured, else when its trip or alert ends, else the feed time it was last sent at
+    for name in ("trip_update", "vehicle", "alert"):
+        message = entity.get(name) if isinstance(entity, dict) else (getattr(entity, name) if entity.HasField(name) else None)
+        if not message:
+            continue
+        if name == "trip_update":
+            return _timestamp(message) or max(
+                (
+                    int(_field(_field(update, event, {}) or {}, "time", 0) or 0)
+                    for update in _field(message, "stop_time_update", []) or []
+                    for event in ("arrival", "departure")
+                ),
+                default=0,
+            ) or feed_time
+        if name == "vehicle":
+            return _timestamp(message) or feed_time
+        ends = [int(_field(period, "end", 0) or 0) for period in _field(message, "active_period", []) or []]
+        return max(ends) if ends and all(ends) else feed_time
+    return feed_time
+
+class RealtimeState:
+    """Entities of a DIFFERENTIAL feed by entity id, with the feed time they were measured at."""
+
+    def __init__(self):
+        self._entities = {}
+        self.feed_time = 0
+
+    def apply(self, header, feed_entities):
+        """Upsert the entities of a differential update, and remove the deleted ones."""
+        # feed time comes from the producer, local clock only for a header without timestamp
+        self.feed_time = max(self.feed_time, _timestamp(header) or int(time.time()))
+        for entity in feed_entities:
+            if isinstance(entity, dict):
+                entity_id, is_deleted = entity.get("id"), entity.get("is_deleted", False)
+            else:
+                entity_id, is_deleted = entity.id, entity.is_deleted
+            if is_deleted:
+                self._entities.pop(entity_id, None)
+            else:
+                self._entities[entity_id] = (_entity_timestamp(entity, self.feed_time), entity)
+
+    def expire(self, max_age):
+        """Remove the entities measured more than max_age seconds of feed time ago.
+
+        An entity without a timestamp of its own counts from its last stop time or
+        alert end, else from the feed time it was last sent at, so every entity expires.
+        """
+        expired = [
+            entity_id for entity_id, (measured_at, entity) in self._entities.items()
+            if self.feed_time - measured_at > max_age
+        ]
+        for entity_id in expired:
+            del self._entities[entity_id]
+
+    def entities(self):
+        return [entity for measured_at, entity in self._entities.values()]
+
+def _feed_key(url, headers, label):
+    return (url, tuple(sorted((headers or {}).items())), label)
+
+class RealtimeHub:
+    """Realtime feeds shared by all entries, each url and headers fetched at most once per ttl."""
+
+    def __init__(self, hass):
+        self.hass = hass
+        self._feeds = {}
+        self._indexes = {}
+        self._fetches = {}
+        self._host_limits = {}
+        # etag, last modified and header timestamp of the cached feeds
+        self._validators = {}
+        # accumulated entities of the differential feeds
+        self._states = {}
+
+    async def async_get_feed_entities(self, entry_id, url, headers, label, ttl=DEFAULT_RT_FEED_TTL):
+        key = _feed_key(url, headers, label)
+        fetched = self._feeds.get(key)
+        if fetched is not None and time.monotonic() - fetched[0] < ttl:
+            _LOGGER.debug("GTFS RT shared %s for url: %s", label, url)
+            return fetched[1]
+        # callers of the same feed wait for the fetch in flight and share its result
+        if key not in self._fetches:
+            task = self.hass.async_create_background_task(
+                self._async_fetch(key, url, headers, label), f"gtfs2 realtime {label}"
+            )
+            self._fetches[key] = (task, set())
+            task.add_done_callback(partial(self._fetch_done, key))
+        task, entry_ids = self._fetches[key]
+        entry_ids.add(entry_id)
+        # an entry unloading while waiting does not cancel the fetch of the others
+        return await asyncio.shield(task)
+
+    def _fetch_done(self, key, task):
+        if key in self._fetches and self._fetches[key][0] is task:
+            del self._fetches[key]
+
+    async def _async_fetch(self, key, url, headers, label):
+        host = urlparse(url).netloc
+        limit = self._host_limits.setdefault(host, asyncio.Semaphore(RT_MAX_HOST_FETCHES))
+        fetched = self._feeds.get(key)
+        validators = self._validators.get(key, {}) if fetched is not None else {}
+        conditional = {}
+        if validators.get("etag"):
+            conditional["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            conditional["If-Modified-Since"] = validators["last_modified"]
+        content, response_headers = await async_fetch_feed(self.hass, url, {**(headers or {}), **conditional}, limit)
+        timestamp = None if content is None else feed_header_timestamp(content)
+        if content is None or (timestamp is not None and timestamp == validators.get("timestamp")):
+            # same snapshot as the cached one, its entities and index are kept
+            _LOGGER.debug("GTFS RT %s unchanged for url: %s", label, url)
+            feed_entities = fetched[1]
+        else:
+            header, feed_entities = await self.hass.async_add_executor_job(
+                parse_feed, content, response_headers.get("Content-Type", ""), label
+            )
+            if _is_differential(header):
+                # expired against the feed time, a feed that stops updating keeps its entities
+                state = self._states.setdefault(key, RealtimeState())
+                state.apply(header, feed_entities)
+                state.expire(RT_ENTITY_EXPIRY)
+                feed_entities = state.entities()
+                _LOGGER.debug("GTFS RT %s differential state for url: %s, entities: %s", label, url, len(feed_entities))
+            else:
+                self._states.pop(key, None)
+        self._feeds[key] = (time.monotonic(), feed_entities)
+        self._validators[key] = {
+            "etag": response_headers.get("ETag") or validators.get("etag"),
+            "last_modified": response_headers.get("Last-Modified") or validators.get("last_modified"),
+            "timestamp": timestamp if content is not None else validators.get("timestamp"),
+        }
+        return feed_entities
+
+    async def _async_get_index(self, key, feed_entities, build, *args):
+        # built in the executor once per parsed snapshot, callers of the same snapshot share the build
+        indexed = self._indexes.get(key)
+        if indexed is None or indexed[0] is not feed_entities or (indexed[1].done() and indexed[1].exception()):
+            indexed = (feed_entities, self.hass.async_add_executor_job(build, feed_entities, *args))
+            self._indexes[key] = indexed
+        return await asyncio.shield(indexed[1])
+
+    async def async_get_trip_update_index(self, entry_id, url, headers, ttl=DEFAULT_RT_FEED_TTL, route_delimiter=None):
+        """Trip update index of the feed, rebuilt only when a new snapshot of the feed was parsed."""
+        feed_entities = await self.async_get_feed_entities(entry_id, url, headers, "trip_data", ttl)
+        key = (_feed_key(url, headers, "trip_data"), route_delimiter)
+        return await self._async_get_index(key, feed_entities, build_trip_update_index, route_delimiter)
+
+    async def async_get_alert_index(self, entry_id, url, headers, ttl=DEFAULT_RT_FEED_TTL):
+        """Alert index of the feed, rebuilt only when a new snapshot of the feed was parsed."""
+        feed_entities = await self.async_get_feed_entities(entry_id, url, headers, "alerts", ttl)
+        key = (_feed_key(url, headers, "alerts"), self.hass.config.language)
+        return await self._async_get_index(key, feed_entities, build_alert_index, self.hass.config.language)
+
+    def async_cancel_entry(self, entry_id):
+        """Stop fetching for an unloaded entry, the fetches no other entry waits for are cancelled."""
+        for task, entry_ids in list(self._fetches.values()):
+            entry_ids.discard(entry_id)
+            if not entry_ids:
+                task.cancel()
+
+
+def get_realtime_hub(hass):
+    """Return the realtime hub of the integration, shared by all entries."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    if REALTIME_HUB not in domain_data:
+        domain_data[REALTIME_HUB] = RealtimeHub(hass)
+    return domain_data[REALTIME_HUB]
+
+async def async_get_rt_feeds(self, vehicles=True, alerts=True):
+    """Fetch the realtime feeds of the entry through the hub, for the lookups below.
+
+    Sets the trip update index, and the vehicle positions and alert index when
+    configured and asked for by the caller, None otherwise.
+    """
+    hub = get_realtime_hub(self.hass)
+    entry_id = self.config_entry.entry_id
+    self._rt_index, self._rt_vehicles, self._rt_alert_index = await asyncio.gather(
+        hub.async_get_trip_update_index(entry_id, self._trip_update_url, self._headers, self._rt_feed_ttl, self._route_delimiter),
+        hub.async_get_feed_entities(entry_id, self._vehicle_position_url, self._headers, "vehicle_positions", self._rt_feed_ttl)
+        if vehicles and self._vehicle_position_url else asyncio.sleep(0),
+        hub.async_get_alert_index(entry_id, self._alerts_url, self._headers, self._rt_feed_ttl)
+        if alerts and (self._alerts_url or "")[:4] == "http" else asyncio.sleep(0),
+    )
 
 def get_next_services(self):
     self._stop = self._stop_id
@@ -152,6 +448,99 @@ def get_next_services(self):
     _LOGGER.debug("Next services attributes: %s", attrs)
     return attrs
     
+def _rt_route_id(route_id, route_delimiter):
+    # If delimiter specified split the route ID in the gtfs rt feed
+    if route_delimiter is not None:
+        route_id_split = route_id.split(route_delimiter)
+        if route_id_split[0] != route_delimiter:
+            return route_id_split[0]
+    return route_id
+
+def _rt_stop_time_delay(stop):
+    # Use stop arrival time;
+    # fall back on departure time if not available
+    if stop["arrival"]["time"] == 0:
+        stop_time = stop["departure"]["time"]
+    else:
+        stop_time = stop["arrival"]["time"]
+    delay = max(stop["departure"].get("delay",0), stop["arrival"].get("delay",0))
+    return stop_time, delay
+
+def _trip_updates(feed_entities):
+    # (route_id, direction_id, trip_id, stop updates) of JSON or protobuf trip update entities
+    for entity in feed_entities:
+        if isinstance(entity, dict):
+            if not entity.get('trip_update', False):
+                continue
+            trip = entity["trip_update"]["trip"]
+            yield (
+                trip["route_id"],
+                trip["direction_id"] if "direction_id" in trip else "nn",
+                trip["trip_id"],
+                ((stop["stop_id"], *_rt_stop_time_delay(stop)) for stop in entity["trip_update"]["stop_time_update"]),
+            )
+        else:
+            # the direction as a string, as the protobuf feed converted to JSON had it
+            trip = entity.trip_update.trip
+            yield (
+                trip.route_id,
+                str(trip.direction_id),
+                trip.trip_id,
+                (
+                    (stop.stop_id, stop.departure.time if stop.arrival.time == 0 else stop.arrival.time, max(stop.departure.delay, stop.arrival.delay))
+                    for stop in entity.trip_update.stop_time_update
+                ),
+            )
+
+def build_trip_update_index(feed_entities, route_delimiter=None):
+    """Index the stop times of a trip updates feed, built once per fetched feed.
+
+    trips: trip_id -> [(route_id, direction_id, {stop_id: stop_times})]
+    route_direction_stops: (route_id, direction_id, stop_id) -> stop_times
+    stops: stop_id -> {(route_id, trip_id): stop_times}
+    A stop_times holds the sorted stop timestamps and the delays in feed order,
+    direction_id is "nn" when the feed has none.
+    """
+    index = {"trips": {}, "route_direction_stops": {}, "stops": {}}
+    for route_id, direction_id, trip_id, stop_updates in _trip_updates(feed_entities):
+        route_id = _rt_route_id(route_id, route_delimiter)
+        trip_stops = {}
+        for stop_id, stop_time, delay in stop_updates:
+            for stop_times in (
+                trip_stops.setdefault(stop_id, {"times": [], "delays": []}),
+                index["route_direction_stops"].setdefault((route_id, direction_id, stop_id), {"times": [], "delays": []}),
+                index["stops"].setdefault(stop_id, {}).setdefault((route_id, trip_id), {"times": [], "delays": []}),
+            ):
+                stop_times["times"].append(stop_time)
+                stop_times["delays"].append(delay)
+        index["trips"].setdefault(trip_id, []).append((route_id, direction_id, trip_stops))
+    for stop_times in index["route_direction_stops"].values():
+        stop_times["times"].sort()
+    for trip_stop_times in index["stops"].values():
+        for stop_times in trip_stop_times.values():
+            stop_times["times"].sort()
+    for trips in index["trips"].values():
+        for route_id, direction_id, trip_stops in trips:
+            for stop_times in trip_stops.values():
+                stop_times["times"].sort()
+    _LOGGER.debug("Trip updates indexed for: %s trips, %s stops", len(index["trips"]), len(index["stops"]))
+    return index
+
+def get_rt_departures(*stop_times_list):
+    """Upcoming departures and delays of one or more stop_times of the trip update index."""
+    times = sorted(t for stop_times in stop_times_list for t in stop_times["times"])
+    # Ignore arrival times in the past
+    first = bisect.bisect_left(times, True, key=lambda t: due_in_minutes(datetime.fromtimestamp(t)) >= 0)
+    return {
+        "departures": [dt_util.as_utc(datetime.fromtimestamp(t)) for t in times[first:]],
+        "delays": [delay for stop_times in stop_times_list for delay in stop_times["delays"]],
+    }
+
+def get_rt_trip_stop_departures(index, route_id, trip_id, stop_id):
+    """Departures and delays of one trip at a stop, as in get_rt_route_trip_statuses."""
+    stop_times = index["stops"].get(stop_id, {}).get((route_id, trip_id))
+    return get_rt_departures(stop_times) if stop_times else {}
+
 def get_rt_route_trip_statuses(self):
     ''' Get next rt departure for route (multiple) or trip (single) '''
     # explanatory logic
@@ -160,220 +549,231 @@ def get_rt_route_trip_statuses(self):
     # if response does not provide a direction_id then use trip_id, make directon temporarily nn and when the stop is identified make it equal to the requesting direction
     # in this case the trip still covers the direction
 
-    departure_times = {}
-    
-    if self._vehicle_position_url:   
-        vehicle_positions = get_rt_vehicle_positions(self)
-
-    feed_entities = get_gtfs_feed_entities(
-        url=self._trip_update_url, headers=self._headers, label="trip_data"
-    )
-    self._feed_entities = feed_entities
+    index = self._rt_index
     _LOGGER.debug("Search departure times for route: %s, trip: %s, type: %s, direction: %s", self._route_id, self._trip_id, self._rt_group, self._direction)
-    for entity in feed_entities:
-
-        if entity.get('trip_update', False):
-            
-            # If delimiter specified split the route ID in the gtfs rt feed
-            if self._route_delimiter is not None:
-                route_id_split = entity["trip_update"]["trip"]["route_id"].split(
-                    self._route_delimiter
-                )
-                if route_id_split[0] == self._route_delimiter:
-                    route_id = entity["trip_update"]["trip"]["route_id"]
-                else:
-                    route_id = route_id_split[0]
-            else:
-                route_id = entity["trip_update"]["trip"]["route_id"]
-
-            if "direction_id" in entity["trip_update"]["trip"]:
-                    direction_id = entity["trip_update"]["trip"]["direction_id"]
-            else:
-                direction_id = "nn"
-                
-            if self._rt_group == "trip":
-                direction_id = self._direction                
-
-            trip_id = entity["trip_update"]["trip"]["trip_id"]  
-                    
-                        
-            if ((self._rt_group == "route" and (route_id == self._route_id and direction_id == self._direction) or (trip_id == self._trip_id and direction_id == "nn") ) or    
-                    (self._rt_group == "trip" and trip_id == self._trip_id )):
-                
-                _LOGGER.debug("Entity found params - group: %s, route_id: %s, direction_id: %s, self_trip_id: %s, with rt trip: %s", self._rt_group, route_id, direction_id, self._trip_id, entity["trip_update"]["trip"])
-                
-                for stop in entity["trip_update"]["stop_time_update"]:
-                    stop_id = stop["stop_id"]
-                    if stop_id == self._stop_id:
-                        _LOGGER.debug("Stop found: %s", stop)
-                        if route_id not in departure_times:
-                            departure_times[route_id] = {}
-                                               
-                        if direction_id == "nn": # i this case the trip_id serves as a basis so one can safely set direction to the requesting entity direction
-                            direction_id = self._direction
-
-                        if direction_id not in departure_times[route_id]:
-                            departure_times[route_id][direction_id] = {}
-                            
-                        if not departure_times[route_id][direction_id].get(
-                            stop_id
-                        ):
-                            departure_times[route_id][direction_id][stop_id] = {}
-                        
-                        if not departure_times[route_id][direction_id][stop_id].get(
-                            "departures"
-                        ):                 
-                            departure_times[route_id][direction_id][stop_id]["departures"] = []
-                            departure_times[route_id][direction_id][stop_id]["delays"] = []
-                        
-                        # Use stop arrival time;
-                        # fall back on departure time if not available                            
-                        if stop["arrival"]["time"] == 0:
-                            stop_time = stop["departure"]["time"]
-                        else:
-                            stop_time = stop["arrival"]["time"]
-                            
-                        if stop["departure"].get("delay",0) >= stop["arrival"].get("delay",0):
-                            delay = stop["departure"].get("delay",0)
-                        else: 
-                            delay = stop["arrival"].get("delay",0)
-                            
-                        # Ignore arrival times in the past
-                        
-                        if due_in_minutes(datetime.fromtimestamp(stop_time)) >= 0:
-                            departure_times[route_id][direction_id][
-                                stop_id
-                            ]["departures"].append(dt_util.as_utc(datetime.fromtimestamp(stop_time)))
-                        else:
-                            _LOGGER.debug("Not using realtime stop data for old due-in-minutes: %s", due_in_minutes(datetime.fromtimestamp(stop_time)))
-                            
-                        departure_times[route_id][direction_id][stop_id]["delays"].append(delay)
-
-                        
-    # Sort by time
-    for route in departure_times:
-        for direction in departure_times[route]:
-            for stop in departure_times[route][direction]:
-                for t in departure_times[route][direction][stop]["departures"]:
-                    departure_times[route][direction][stop]["departures"].sort()
+    found = {}
+    if self._rt_group == "route":
+        stop_times = index["route_direction_stops"].get((self._route_id, self._direction, self._stop_id))
+        if stop_times:
+            found.setdefault(self._route_id, []).append(stop_times)
+    for route_id, direction_id, trip_stops in index["trips"].get(self._trip_id, []):
+        if self._rt_group == "route" and (direction_id != "nn" or route_id == self._route_id and self._direction == "nn"):
+            # already found by route and direction, or not a trip without direction
+            continue
+        if self._stop_id in trip_stops:
+            found.setdefault(route_id, []).append(trip_stops[self._stop_id])
+    # in this case the trip_id serves as a basis so one can safely set direction to the requesting entity direction
+    departure_times = {
+        route_id: {self._direction: {self._stop_id: get_rt_departures(*stop_times_list)}}
+        for route_id, stop_times_list in found.items()
+    }
 
     self.info = departure_times
     _LOGGER.debug("Departure times Route Trip: %s", departure_times)
     return departure_times    
 
-def get_rt_vehicle_positions(self):
-    feed_entities = get_gtfs_feed_entities(
-        url=self._vehicle_position_url,
-        headers=self._headers,
-        label="vehicle_positions",
+def _vehicle_position(entity):
+    # trip_id, route_id, direction_id, vehicle id and label, latitude, longitude of a JSON or protobuf entity
+    if isinstance(entity, dict):
+        vehicle = entity["vehicle"]
+        return (
+            vehicle["trip"]["trip_id"], vehicle["trip"]["route_id"], vehicle["trip"]["direction_id"],
+            vehicle["vehicle"]["id"], vehicle["vehicle"]["label"],
+            vehicle["position"]["latitude"], vehicle["position"]["longitude"],
+        )
+    vehicle = entity.vehicle
+    return (
+        vehicle.trip.trip_id, vehicle.trip.route_id, vehicle.trip.direction_id,
+        vehicle.vehicle.id, vehicle.vehicle.label,
+        vehicle.position.latitude, vehicle.position.longitude,
     )
+
+def get_rt_vehicle_positions(self, feed_entities):
     geojson_body = []
     geojson_element = {"geometry": {"coordinates":[],"type": "Point"}, "properties": {"id": "", "title": "", "trip_id": "", "route_id": "", "direction_id": "", "vehicle_id": "", "vehicle_label": ""}, "type": "Feature"}
     for entity in feed_entities:
-        vehicle = entity["vehicle"]
+        trip_id, route_id, direction_id, vehicle_id, vehicle_label, latitude, longitude = _vehicle_position(entity)
         
-        if not vehicle["trip"]["trip_id"]:
+        if not trip_id:
             # Vehicle is not in service
             continue
-        if vehicle["trip"]["trip_id"] == self._trip_id: 
-            _LOGGER.debug('Adding position for TripId: %s, RouteId: %s, DirectionId: %s, Lat: %s, Lon: %s', vehicle["trip"]["trip_id"],vehicle["trip"]["route_id"],vehicle["trip"]["direction_id"],vehicle["position"]["latitude"],vehicle["position"]["longitude"])  
+        if trip_id == self._trip_id: 
+            _LOGGER.debug('Adding position for TripId: %s, RouteId: %s, DirectionId: %s, Lat: %s, Lon: %s', trip_id, route_id, direction_id, latitude, longitude)  
             
         # add data if in the selected direction
-        if (str(self._route_id) == str(vehicle["trip"]["route_id"]) or str(vehicle["trip"]["trip_id"]) == str(self._trip_id)) and str(self._direction) == str(vehicle["trip"]["direction_id"]):
-            _LOGGER.debug("Found vehicle on route with attributes: %s", vehicle)
+        if (str(self._route_id) == str(route_id) or str(trip_id) == str(self._trip_id)) and str(self._direction) == str(direction_id):
+            _LOGGER.debug("Found vehicle on route with attributes: %s", entity)
             geojson_element = {"geometry": {"coordinates":[],"type": "Point"}, "properties": {"id": "", "title": "", "trip_id": "", "route_id": "", "direction_id": "", "vehicle_id": "", "vehicle_label": ""}, "type": "Feature"}
             geojson_element["geometry"]["coordinates"] = []
-            geojson_element["geometry"]["coordinates"].append(vehicle["position"]["longitude"])
-            geojson_element["geometry"]["coordinates"].append(vehicle["position"]["latitude"])
-            geojson_element["properties"]["id"] = str(self._route_id) + "_" + str(vehicle["vehicle"]["id"]) + "_" + str(vehicle["trip"]["direction_id"])
-            geojson_element["properties"]["title"] =  str(self._route_id) + "_" + str(vehicle["vehicle"]["id"]) + "_" + str(vehicle["trip"]["direction_id"])
-            geojson_element["properties"]["trip_id"] = str(self._route_id) + "_" + str(vehicle["vehicle"]["id"]) + "_" + str(vehicle["trip"]["direction_id"])
+            geojson_element["geometry"]["coordinates"].append(longitude)
+            geojson_element["geometry"]["coordinates"].append(latitude)
+            geojson_element["properties"]["id"] = str(self._route_id) + "_" + str(vehicle_id) + "_" + str(direction_id)
+            geojson_element["properties"]["title"] =  str(self._route_id) + "_" + str(vehicle_id) + "_" + str(direction_id)
+            geojson_element["properties"]["trip_id"] = str(self._route_id) + "_" + str(vehicle_id) + "_" + str(direction_id)
             geojson_element["properties"]["route_id"] = str(self._route_id)
-            geojson_element["properties"]["direction_id"] = vehicle["trip"]["direction_id"]
-            geojson_element["properties"]["vehicle_id"] = vehicle["vehicle"]["id"]
-            geojson_element["properties"]["vehicle_label"] = vehicle["vehicle"]["label"]
-            geojson_element["properties"][vehicle["trip"]["trip_id"]] = geojson_element["geometry"]["coordinates"]
+            geojson_element["properties"]["direction_id"] = direction_id
+            geojson_element["properties"]["vehicle_id"] = vehicle_id
+            geojson_element["properties"]["vehicle_label"] = vehicle_label
+            geojson_element["properties"][trip_id] = geojson_element["geometry"]["coordinates"]
             geojson_body.append(geojson_element)
     
     self.geojson = {"features": geojson_body, "type": "FeatureCollection"}
         
-    _LOGGER.debug("Vehicle geojson: %s", json.dumps(self.geojson))
+    _LOGGER.debug("Vehicle geojson: %s", self.geojson)
     self._route_dir = str(self._route_id) + "_" + str(self._direction)
     update_geojson(self)
     return geojson_body
     
+def _field(message, name, default=None):
+    # a field of a protobuf message or of its JSON dict
+    if isinstance(message, dict):
+        return message.get(name, default)
+    return getattr(message, name, default)
+
+def _translated_text(translated_string, language=None):
+    # the translation in the language of home assistant, else the first one
+    translations = list(_field(translated_string, "translation", []) or [])
+    for translation in translations:
+        if language and (_field(translation, "language") or "").split("-")[0] == language.split("-")[0]:
+            return _field(translation, "text", "")
+    return _field(translations[0], "text", "") if translations else ""
+
+def build_alert_index(feed_entities, language=None):
+    """Index the alerts of a feed, built once per fetched feed.
+
+    stops, routes and trips map a stop_id, route_id or trip_id to the alerts informing it alone,
+    route_stops maps (route_id, stop_id) to the alerts of a route at a stop.
+    An alert holds its translated header and description and its active periods, as int
+    seconds (JSON feeds give uint64 as strings) with 0 for a missing, unbounded start or end.
+    """
+    index = {"stops": {}, "routes": {}, "trips": {}, "route_stops": {}}
+    for entity in feed_entities:
+        if isinstance(entity, dict):
+            alert = entity.get("alert")
+        else:
+            alert = entity.alert if entity.HasField("alert") else None
+        if not alert:
+            continue
+        entry = {
+            "header_text": _translated_text(_field(alert, "header_text", {}), language),
+            "description_text": _translated_text(_field(alert, "description_text", {}), language),
+            "active_periods": [
+                (int(_field(period, "start", 0) or 0), int(_field(period, "end", 0) or 0))
+                for period in _field(alert, "active_period", []) or []
+            ],
+        }
+        for informed in _field(alert, "informed_entity", []) or []:
+            stop_id = _field(informed, "stop_id")
+            route_id = _field(informed, "route_id")
+            trip_id = _field(_field(informed, "trip", {}) or {}, "trip_id") or _field(informed, "trip_id")
+            if trip_id:
+                alerts = index["trips"].setdefault(trip_id, [])
+            elif stop_id and route_id:
+                alerts = index["route_stops"].setdefault((route_id, stop_id), [])
+            elif stop_id:
+                alerts = index["stops"].setdefault(stop_id, [])
+            elif route_id:
+                alerts = index["routes"].setdefault(route_id, [])
+            else:
+                # agency or route type wide, not matched to a sensor
+                continue
+            if not alerts or alerts[-1] is not entry:
+                alerts.append(entry)
+    _LOGGER.debug("Alerts indexed for: %s stops, %s routes, %s trips", len(index["stops"]), len(index["routes"]), len(index["trips"]))
+    return index
+
+def _alert_active(alert, now):
+    if not alert["active_periods"]:
+        return True
+    return any((not start or start <= now) and (not end or now <= end) for start, end in alert["active_periods"])
+
 def get_rt_alerts(self):
     rt_alerts = {}
-    if (self._alerts_url)[:4] == "http":
-        feed_entities = get_gtfs_feed_entities(
-            url=self._alerts_url,
-            headers=self._headers,
-            label="alerts",
-        )
-        for entity in feed_entities:
-            if entity.HasField("alert"):
-                for x in entity.alert.informed_entity:
-                    if x.HasField("stop_id"):
-                        stop_id = x.stop_id 
-                    else:
-                        stop_id = "unknown"
-                    if x.HasField("stop_id"):
-                        route_id = x.route_id  
-                    else:
-                        route_id = "unknown"
-                if stop_id == self._stop_id and (route_id == "unknown" or route_id == self._route_id): 
-                    _LOGGER.debug("RT Alert for route: %s, stop: %s, alert: %s", route_id, stop_id, entity.alert.header_text)
-                    rt_alerts["origin_stop_alert"] = (str(entity.alert.header_text).split('text: "')[1]).split('"',1)[0].replace(':','').replace('\n','')
-                if stop_id == self._destination_id and (route_id == "unknown" or route_id == self._route_id): 
-                    _LOGGER.debug("RT Alert for route: %s, stop: %s, alert: %s", route_id, stop_id, entity.alert.header_text)
-                    rt_alerts["destination_stop_alert"] = (str(entity.alert.header_text).split('text: "')[1]).split('"',1)[0].replace(':','').replace('\n','')
-                if stop_id == "unknown" and route_id == self._route_id: 
-                    _LOGGER.debug("RT Alert for route: %s, stop: %s, alert: %s", route_id, stop_id, entity.alert.header_text)
-                    rt_alerts["origin_stop_alert"] = (str(entity.alert.header_text).split('text: "')[1]).split('"',1)[0].replace(':','').replace('\n','')
-                    rt_alerts["destination_stop_alert"] = (str(entity.alert.header_text).split('text: "')[1]).split('"',1)[0].replace(':','').replace('\n','')    
-                        
+    if self._rt_alert_index is not None:
+        index = self._rt_alert_index
+        now = time.time()
+        route_alerts = index["routes"].get(self._route_id, []) + index["trips"].get(self._trip_id, [])
+        for attr, stop_id in (("origin_stop_alert", self._stop_id), ("destination_stop_alert", self._destination_id)):
+            alerts = index["route_stops"].get((self._route_id, stop_id), []) + index["stops"].get(stop_id, []) + route_alerts
+            texts = list(dict.fromkeys(alert["header_text"] for alert in alerts if _alert_active(alert, now)))
+            if texts:
+                _LOGGER.debug("RT Alert for route: %s, stop: %s, alert: %s", self._route_id, stop_id, texts)
+                rt_alerts[attr] = "; ".join(texts)
     return rt_alerts
-    
+
 def get_rt_alerts_json(self):
-    rt_alerts = {}
-    if (self._alerts_url)[:4] == "http":
-        feed_entities = get_gtfs_feed_entities(
-            url=self._alerts_url,
-            headers=self._headers,
-            label="alerts",
-        )
-        for entity in feed_entities:
-            if entity["alert"]:
-                for x in entity["alert"]["informed_entity"]:
-                    if x["stop_id"]:
-                        stop_id = x["stop_id"] 
-                    else:
-                        stop_id = "unknown"
-                    if x["route_id"]:
-                        route_id = x["route_id"]  
-                    else:
-                        route_id = "unknown"
-                if stop_id == self._stop_id and (route_id == "unknown" or route_id == self._route_id): 
-                    _LOGGER.debug("RT Alert for route: %s, stop: %s, alert: %s", route_id, stop_id, entity["alert"]["header_text"])
-                    rt_alerts["origin_stop_alert"] = (str(entity["alert"]["header_text"]).split('text: "')[1]).split('"',1)[0].replace(':','').replace('\n','')
-                if stop_id == self._destination_id and (route_id == "unknown" or route_id == self._route_id): 
-                    _LOGGER.debug("RT Alert for route: %s, stop: %s, alert: %s", route_id, stop_id, entity["alert"]["header_text"])
-                    rt_alerts["destination_stop_alert"] = (str(entity["alert"]["header_text"]).split('text: "')[1]).split('"',1)[0].replace(':','').replace('\n','')
-                if stop_id == "unknown" and route_id == self._route_id: 
-                    _LOGGER.debug("RT Alert for route: %s, stop: %s, alert: %s", route_id, stop_id, entity["alert"]["header_text"])
-                    rt_alerts["origin_stop_alert"] = (str(entity["alert"]["header_text"]).split('text: "')[1]).split('"',1)[0].replace(':','').replace('\n','')
-                    rt_alerts["destination_stop_alert"] = (str(entity["alert"]["header_text"]).split('text: "')[1]).split('"',1)[0].replace(':','').replace('\n','')    
-                        
-    return rt_alerts
+    # the alert index reads JSON feeds as well
+    return get_rt_alerts(self)
     
     
+class GeojsonWriter:
+    """Writes the vehicle geojson files, coalesced per file and skipped when the content is unchanged."""
+
+    def __init__(self, hass):
+        self.hass = hass
+        self._pending = {}
+        self._written = {}
+        self._lock = threading.Lock()
+        # one write at a time, the last content popped is the last written
+        self._write_lock = threading.Lock()
+
+    def write(self, file, geojson):
+        """Schedule a write of geojson to file, safe to call from any thread."""
+        content = json.dumps(geojson).encode()
+        digest = hashlib.sha1(content).digest()
+        with self._lock:
+            if file not in self._pending and self._written.get(file) == digest:
+                return
+            scheduled = file in self._pending
+            self._pending[file] = (digest, content)
+        if not scheduled:
+            # the sensors of a route and direction refresh together, their writes are merged
+            self.hass.loop.call_soon_threadsafe(self._async_schedule, file)
+
+    @callback
+    def _async_schedule(self, file):
+        async_call_later(self.hass, GEOJSON_WRITE_DELAY, partial(self._async_flush, file))
+
+    async def _async_flush(self, file, _now):
+        await self.hass.async_add_executor_job(self._flush, file)
+
+    def _flush(self, file):
+        with self._write_lock:
+            with self._lock:
+                pending = self._pending.pop(file, None)
+            if pending is None:
+                return
+            digest, content = pending
+            if file not in self._written and os.path.exists(file):
+                with open(file, "rb") as current:
+                    self._written[file] = hashlib.sha1(current.read()).digest()
+            if self._written.get(file) == digest:
+                return
+            _LOGGER.debug("Creating geojson file: %s", file)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            # readers of the www folder never see a partly written file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), prefix=".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as outfile:
+                    outfile.write(content)
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, file)
+            except OSError:
+                os.remove(tmp)
+                raise
+            self._written[file] = digest
+
+
+def get_geojson_writer(hass):
+    """Return the geojson writer of the integration, shared by all entries."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    if GEOJSON_WRITER not in domain_data:
+        domain_data[GEOJSON_WRITER] = GeojsonWriter(hass)
+    return domain_data[GEOJSON_WRITER]
+
 def update_geojson(self):    
-    geojson_dir = self.hass.config.path(DEFAULT_PATH_GEOJSON)
-    os.makedirs(geojson_dir, exist_ok=True)
-    file = os.path.join(geojson_dir, self._route_dir + ".json")
-    _LOGGER.debug("Creating geojson file: %s", file)
-    with open(file, "w") as outfile:
-        json.dump(self.geojson, outfile)
+    file = os.path.join(self.hass.config.path(DEFAULT_PATH_GEOJSON), self._route_dir + ".json")
+    get_geojson_writer(self.hass).write(file, self.geojson)
     
 def get_gtfs_rt(hass, path, data):
     """Get gtfs rt data."""
@@ -404,6 +804,7 @@ def get_gtfs_rt(hass, path, data):
                 url=data.get("url", None),
                 headers=_headers,
                 label=data.get("rt_type", "-"),
+                as_json=True,
             )
             file_all = data["file"] + "_converted.txt" 
         except Exception as ex:  # pylint: disable=broad-except
@@ -0,0 +1,84 @@
+"""Schedule registry for the GTFS integration, one pygtfs Schedule per datasource file."""
+from __future__ import annotations
+
+import functools
+import logging
+import os
+import threading
+
+import pygtfs
+from sqlalchemy.sql import text
+
+from .const import DOMAIN, SCHEDULE_REGISTRY
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _file_identity(sqlite_file):
+    # an extraction swaps in a new file, an index upgrade rewrites the current one
+    stat = os.stat(sqlite_file)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=128)
+def _statement(sql):
+    return text(sql)
+
+
+def fetch_all(schedule, sql, params=None):
+    """Run sql on a pooled connection of the schedule and return all rows, the connection goes back right away."""
+    with schedule.engine.connect() as conn:
+        return conn.execute(_statement(sql), params or {}).all()
+
+
+class ScheduleRegistry:
+    """Keeps one Schedule (engine and connection pool) per datasource, shared by the entries using it."""
+
+    def __init__(self):
+        self._schedules = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, sqlite_file):
+        """Return the Schedule of sqlite_file, reopened only when the file changed since it was opened."""
+        identity = _file_identity(sqlite_file)
+        with self._lock:
+            cached = self._schedules.get(sqlite_file)
+            if cached is not None and cached[1] == identity:
+                return cached[0]
+            if cached is not None:
+                _LOGGER.debug("Datasource changed, reopening: %s", sqlite_file)
+                cached[0].engine.dispose()
+            schedule = pygtfs.Schedule(f"{sqlite_file}?check_same_thread=False")
+            self._schedules[sqlite_file] = (schedule, _file_identity(sqlite_file))
+            return schedule
+
+    def invalidate(self, sqlite_file):
+        """Dispose the Schedule of sqlite_file, the next get opens it again."""
+        with self._lock:
+            cached = self._schedules.pop(sqlite_file, None)
+        if cached is not None:
+            _LOGGER.debug("Closing datasource: %s", sqlite_file)
+            cached[0].engine.dispose()
+
+    def add_entry(self, sqlite_file, entry_id):
+        with self._lock:
+            self._entries[entry_id] = sqlite_file
+
+    def remove_entry(self, entry_id):
+        """Forget the entry, disposes the datasources no remaining entry uses."""
+        with self._lock:
+            self._entries.pop(entry_id, None)
+            in_use = set(self._entries.values())
+            # also closes the datasources only opened by the config flow
+            unused = [path for path in self._schedules if path not in in_use]
+        for path in unused:
+            self.invalidate(path)
+
+
+def get_schedule_registry(hass):
+    """Return the schedule registry of the integration, shared by all entries and the config flow."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    if SCHEDULE_REGISTRY not in domain_data:
+        domain_data[SCHEDULE_REGISTRY] = ScheduleRegistry()
+    return domain_data[SCHEDULE_REGISTRY]
@@ -6,6 +6,7 @@ from typing import Any
 from homeassistant.components.sensor import SensorDeviceClass, SensorEntity
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant, callback
+from homeassistant.const import EntityCategory
 from homeassistant.helpers.device_registry import DeviceEntryType, DeviceInfo
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
@@ -39,6 +40,8 @@ from .const import (
     BICYCLE_ALLOWED_DEFAULT,
     BICYCLE_ALLOWED_OPTIONS,
     DEFAULT_NAME,
+    DATASOURCE_SENSORS,
+    DEFAULT_PATH,
     DOMAIN,
     DROP_OFF_TYPE_DEFAULT,
     DROP_OFF_TYPE_OPTIONS,
@@ -57,6 +60,8 @@ from .const import (
     WHEELCHAIR_BOARDING_OPTIONS,
 )
 from .coordinator import GTFSUpdateCoordinator, GTFSLocalStopUpdateCoordinator
+from .extraction import get_extraction_queue
+from .gtfs_loader import read_progress
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -88,6 +93,12 @@ async def async_setup_entry(
             GTFSDepartureSensor(coordinator),
         ]
 
+    # one datasource sensor per file, owned by the first entry that uses it
+    datasource_sensors = hass.data[DOMAIN].setdefault(DATASOURCE_SENSORS, {})
+    if config_entry.data["file"] not in datasource_sensors:
+        datasource_sensors[config_entry.data["file"]] = config_entry.entry_id
+        sensors.append(GTFSDatasourceSensor(config_entry.data["file"]))
+
     async_add_entities(sensors, False)
     
 class GTFSDepartureSensor(CoordinatorEntity, SensorEntity):
@@ -528,3 +539,41 @@ class GTFSLocalStopSensor(CoordinatorEntity, SensorEntity):
           
         self._attr_extra_state_attributes = self._attributes
         return self._attr_extra_state_attributes
+
+
+class GTFSDatasourceSensor(SensorEntity):
+    """Diagnostic sensor with the extraction progress of a datasource, shared by its entries."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_icon = "mdi:database-sync"
+
+    def __init__(self, file) -> None:
+        """Initialize the datasource sensor."""
+        self._file = file
+        self._attr_name = f"{file} datasource"
+        self._attr_unique_id = f"gtfs-{file}-datasource"
+        self._attr_device_info = DeviceInfo(
+            name=f"GTFS datasource - {file}",
+            entry_type=DeviceEntryType.SERVICE,
+            identifiers={(DOMAIN, f"GTFS datasource - {file}")},
+            manufacturer="GTFS",
+            model=file,
+        )
+        self._attr_native_value = "idle"
+
+    async def async_update(self) -> None:
+        """Read the progress published by the loader."""
+        status = await self.hass.async_add_executor_job(
+            read_progress, self.hass.config.path(DEFAULT_PATH, self._file + ".progress")
+        )
+        state = status.pop("state", "idle")
+        queue = get_extraction_queue(self.hass)
+        job = queue.status(self._file)
+        if state == "queued" and job.get("state") == "running":
+            # picked up by a worker that did not publish progress yet
+            state = "running"
+        # left over from a restart during extraction
+        if state in ["queued", "running", "loading", "indexing", "validating"] and not queue.is_active(self._file):
+            state = "interrupted"
+        self._attr_native_value = state
+        self._attr_extra_state_attributes = {**{key: value for key, value in job.items() if key != "state"}, **status}